@@ -0,0 +1,56 @@
+"""Read save files stored in zip and tar archives without extracting them
+
+A save inside an archive is named '<archive>/<member>', e.g.
+'history.tar.gz/NGUSave-Build-1.txt'.
+"""
+import fnmatch
+import os
+import posixpath
+import tarfile
+import zipfile
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def split_member(path):
+    """Return (archive, member) of an archive member name, or (None, path)"""
+    lower = path.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        end = lower.find(suffix + '/')
+        while end != -1:
+            archive = path[:end + len(suffix)]
+            if os.path.isfile(archive):
+                return archive, path[len(archive) + 1:]
+            end = lower.find(suffix + '/', end + 1)
+    return None, path
+
+
+def iter_members(archive, pattern='*'):
+    """Yield (name, data) of the files in archive whose base name matches pattern
+
+    Members are read in archive order in a single pass; tar archives are read
+    as a stream, so compressed tarballs are decompressed once.
+    """
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as _zf:
+            for info in _zf.infolist():
+                if not info.is_dir() and fnmatch.fnmatch(posixpath.basename(info.filename), pattern):
+                    yield f"{archive}/{info.filename}", _zf.read(info)
+        return
+    with tarfile.open(archive, 'r|*') as _tf:
+        for member in _tf:
+            if member.isfile() and fnmatch.fnmatch(posixpath.basename(member.name), pattern):
+                yield f"{archive}/{member.name}", _tf.extractfile(member).read()
+
+
+def read_member(archive, member):
+    """Return the data of one archive member"""
+    if archive.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive) as _zf:
+            return _zf.read(member)
+    with tarfile.open(archive) as _tf:
+        return _tf.extractfile(member).read()
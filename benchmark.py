@@ -0,0 +1,317 @@
+"""Benchmark save-game decoding and parsing"""
+import argparse
+import base64
+import contextlib
+import csv
+import io
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from deserialize_dot_net import Deserializer, RECORD_TYPES, compile_path, np
+from parse_saves import HEADERS, decode_savegame, header_columns, read_savegame
+from synthetic_save import deep_chain, player_stream
+
+LOG = logging.getLogger()
+
+
+def time_call(func, repeat):
+    """Return the wall-clock time in seconds of each of `repeat` calls to func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_save(fname, repeat):
+    decode_times = time_call(lambda: decode_savegame(fname), repeat)
+    data, pos = decode_savegame(fname)
+
+    def parse():
+        des = Deserializer(data, pos)
+        des.parse()
+        des.get('PlayerData')
+
+    parse_times = time_call(parse, repeat)
+    return {
+        'file': fname,
+        'size': len(data) - pos,
+        'decode': min(decode_times),
+        'parse': min(parse_times),
+        'parse_mean': statistics.mean(parse_times),
+    }
+
+
+def peak_memory(func):
+    """tracemalloc peak in bytes while running func"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(fname):
+    """Peak parse memory of the dict and compact representations"""
+    data, pos = decode_savegame(fname)
+    variants = {'dict': {}, 'compact': {'compact': True}}
+    if np is not None:
+        variants['compact+view'] = {'compact': True, 'primarr_view': True}
+    res = {}
+    for name, kwargs in variants.items():
+        res[name] = peak_memory(lambda: Deserializer(data, pos, **kwargs).parse())
+    return res
+
+
+def read_decode(fname):
+    """Straightforward decode of a save (file, outer and payload all copied in full)"""
+    with open(fname, 'rb') as _fh:
+        data = base64.b64decode(_fh.read())
+    data = base64.b64decode(data[data.index(b'checksum') + 34:])
+    return data, data.index(b'PlayerData') - 6
+
+
+DECODERS = {
+    'none': lambda fname: None,
+    'read': read_decode,
+    'mmap': decode_savegame,
+}
+
+# run in a fresh interpreter per decoder as peak RSS never goes down. VmHWM
+# is preferred, ru_maxrss keeps the peak of the parent process across fork
+RSS_SCRIPT = """
+import sys
+# the repo directory, so benchmark imports from any working directory
+sys.path.insert(0, sys.argv[3])
+import benchmark
+benchmark.DECODERS[sys.argv[2]](sys.argv[1])
+try:
+    with open('/proc/self/status') as _fh:
+        print(next(_l.split()[1] for _l in _fh if _l.startswith('VmHWM:')))
+except OSError:
+    import resource
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_decode_memory(fname):
+    """Peak RSS (KiB, includes the interpreter) and tracemalloc peak of each decoder"""
+    res = {}
+    for name, decoder in DECODERS.items():
+        proc = subprocess.run([sys.executable, '-c', RSS_SCRIPT, fname, name,
+                               os.path.dirname(os.path.abspath(__file__))],
+                              capture_output=True, text=True, check=True)
+        res[name] = {'rss': int(proc.stdout), 'peak': peak_memory(lambda: decoder(fname))}
+    return res
+
+
+def bench_paths(fname, repeat, trees=1000):
+    """Time extracting HEADERS from `trees` copies of a save with get, accessors and in batch"""
+    obj = read_savegame(fname)
+    batch = [obj] * trees
+    paths = [_k + "/value" for _k in HEADERS.values()]
+
+    def dictquery():
+        for tree in batch:
+            [tree.get(_p) for _p in paths]
+
+    def compiled():
+        for tree in batch:
+            [compile_path(_p)(tree) for _p in paths]
+
+    return {
+        'get': min(time_call(dictquery, repeat)),
+        'compiled': min(time_call(compiled, repeat)),
+        'columns': min(time_call(lambda: header_columns(batch), repeat)),
+    }
+
+
+def write_trace(fname, writer):
+    """Parse fname once, writing one CSV row per record"""
+    data, pos = decode_savegame(fname)
+    des = Deserializer(data, pos, trace_records=True)
+    des.parse()
+    for _type, offset, size, cname in des.records:
+        writer.writerow([fname, _type, RECORD_TYPES.get(_type, ''), offset, size, cname or ''])
+
+
+def bench_deep_chain(depth, repeat):
+    data, pos = deep_chain(depth)
+
+    def parse():
+        des = Deserializer(data, pos)
+        des.parse()
+        return des
+
+    times = time_call(parse, repeat)
+    # walk the chain iteratively to check every reference was resolved
+    node = parse().get('Node')
+    length = 0
+    while node is not None:
+        length += 1
+        assert node['v']['value'] == length
+        node = node['next']['value']
+    assert length == depth, length
+    return {'records': depth, 'parse': min(times)}
+
+
+def bench_scaling(scales, repeat):
+    """Throughput and peak memory of each parse mode on synthetic saves of each scale"""
+    modes = {
+        'parse': lambda des: des.parse(),
+        'compact': lambda des: des.parse(),
+        'scan': lambda des: des.scan(),
+        'events': lambda des: sum(1 for _ in des.iter_events()),
+    }
+    results = []
+    for scale in scales:
+        data, pos = player_stream(scale)
+        des = Deserializer(data, pos)
+        des.parse()
+        records = len(des.idmap)
+        for mode, func in modes.items():
+            kwargs = {'compact': True} if mode == 'compact' else {}
+            best = min(time_call(lambda: func(Deserializer(data, pos, **kwargs)), repeat))
+            # measured separately, tracemalloc slows the parser down considerably
+            peak = peak_memory(lambda: func(Deserializer(data, pos, **kwargs)))
+            results.append({
+                'scale': scale, 'mode': mode, 'size': len(data) - pos, 'records': records,
+                'time': best, 'peak': peak,
+            })
+    return results
+
+
+def optimizer_instance(n_items, seed=1, accs=12):
+    """Random 'ngu' gear problem: n_items candidates, 1 of each slot and accs accessories"""
+    rng = np.random.default_rng(seed)
+    slots = max(n_items // 10, 2)
+    item_groups = [(slots, 1)] * 5 + [(max(n_items - 5 * slots, accs + 1), accs)]
+    count = sum(_g[0] for _g in item_groups)
+    stats = rng.uniform(0, 0.5, (5, count)) * (rng.random((5, count)) < 0.4)
+    # a few items exist twice, for the uniqueness constraint
+    unique = np.arange(count, dtype=float)[None]
+    copies = rng.choice(count, count // 20, replace=False)
+    unique[0, copies] = rng.choice(count, len(copies))
+    return stats, item_groups, unique
+
+
+def bench_optimizer(n_items, repeat, accs=12):
+    """GA generations per second and evaluation time of one population, elementwise and batched,
+    and the time of the exact solver"""
+    from optimizer import EXACT_MAX_SPACE, MySampling, SubsetProblem, exact_solver, run_optimizer
+    from stats import func_ABC_ADE
+    stats, item_groups, unique = optimizer_instance(n_items, accs=accs)
+    func = func_ABC_ADE(range(5))
+
+    def run(**kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run_optimizer(stats, 0, item_groups, func, unique=unique, **kwargs)[1]
+
+    results = {}
+    for name, elementwise in (('elementwise', True), ('batched', False)):
+        problem = SubsetProblem(stats, 0, item_groups, func, unique=unique, elementwise=elementwise)
+        X = MySampling()._do(problem, stats.shape[1])
+        evaluate = min(time_call(lambda: problem.evaluate(X), repeat))
+        best = min(time_call(lambda: run(elementwise=elementwise, method='ga'), repeat))
+        res = run(elementwise=elementwise, method='ga')
+        results[name] = {'gens': res.algorithm.n_gen, 'time': best, 'F': res.F[0],
+                         'pop': len(X), 'evaluate': evaluate}
+    solver = exact_solver(stats, 0, item_groups, func, unique)
+    if solver is not None and solver.combinations() > EXACT_MAX_SPACE:
+        # the exact search would take far longer than the GA
+        LOG.warning("The problem is too large for the exact solver")
+        return results
+    try:
+        best = min(time_call(lambda: run(method='exact'), repeat))
+        res = run(method='exact')
+        results['exact'] = {'time': best, 'F': res.F[0], 'states': res.states}
+    except ValueError as _e:
+        LOG.warning("%s", _e)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("saves", metavar='SAVEFILE', nargs='*',
+                        help="List of save files to benchmark")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed runs per save (best is reported)")
+    parser.add_argument("--deep-chain", type=int, metavar='DEPTH',
+                        help="Stress reference resolution with a chain of DEPTH objects")
+    parser.add_argument("--synthetic", metavar='SCALES',
+                        help="Benchmark generated saves of each comma separated scale (e.g. 1,10,100)")
+    parser.add_argument("--optimizer", type=int, metavar='ITEMS',
+                        help="Time the gear optimizer GA on a random problem with ITEMS candidate items")
+    parser.add_argument("--accessories", type=int, default=12,
+                        help="Number of accessories of the --optimizer problem")
+    parser.add_argument("--memory", action="store_true",
+                        help="Report peak parse memory of the dict and compact representations")
+    parser.add_argument("--decode-memory", action="store_true",
+                        help="Report peak RSS of decoding with and without the mmap pipeline")
+    parser.add_argument("--paths", action="store_true",
+                        help="Time HEADERS extraction from parsed saves by path string and compiled accessors")
+    parser.add_argument("--trace", metavar='CSVFILE',
+                        help="Write the type, offset and size of every record to CSVFILE")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.deep_chain:
+        res = bench_deep_chain(args.deep_chain, args.repeat)
+        print(f"Resolved a {res['records']} object reference chain in {res['parse'] * 1000:.2f} ms")
+    if args.synthetic:
+        print(f"{'scale':>6s} {'mode':8s} {'KiB':>9s} {'records':>8s} {'ms':>9s} "
+              f"{'MB/s':>7s} {'records/s':>10s} {'peak KiB':>9s}")
+        for res in bench_scaling([int(_s) for _s in args.synthetic.split(',')], args.repeat):
+            print(f"{res['scale']:6d} {res['mode']:8s} {res['size'] / 1024:9.1f} {res['records']:8d} "
+                  f"{res['time'] * 1000:9.2f} {res['size'] / res['time'] / 1e6:7.1f} "
+                  f"{res['records'] / res['time']:10.0f} {res['peak'] / 1024:9.0f}")
+    if args.optimizer:
+        for name, res in bench_optimizer(args.optimizer, args.repeat, args.accessories).items():
+            if name == 'exact':
+                print(f"{name:12s} {res['states']:4d} partial loadouts in {res['time'] * 1000:8.2f} ms, "
+                      f"best {res['F']:.6g}")
+                continue
+            print(f"{name:12s} {res['gens']:4d} generations in {res['time'] * 1000:9.2f} ms, "
+                  f"{res['gens'] / res['time']:8.1f} gens/s, best {res['F']:.6g}, "
+                  f"evaluating {res['pop']} individuals {res['evaluate'] * 1000:.2f} ms")
+    if not args.saves:
+        return
+    print(f"{'save':40s} {'KiB':>8s} {'decode ms':>10s} {'parse ms':>10s} {'mean ms':>10s}")
+    total = 0
+    for fname in args.saves:
+        res = bench_save(fname, args.repeat)
+        total += res['parse']
+        print(f"{res['file'][-40:]:40s} {res['size'] / 1024:8.1f} {res['decode'] * 1000:10.2f} "
+              f"{res['parse'] * 1000:10.2f} {res['parse_mean'] * 1000:10.2f}")
+    if len(args.saves) > 1:
+        print(f"Average parse time per save: {total / len(args.saves) * 1000:.2f} ms")
+    if args.memory:
+        for fname in args.saves:
+            res = bench_memory(fname)
+            print(f"{fname[-40:]:40s} peak KiB: " +
+                  ", ".join(f"{_k} {_v / 1024:.0f}" for _k, _v in res.items()))
+    if args.decode_memory:
+        print(f"{'save':40s} {'decoder':8s} {'peak RSS KiB':>13s} {'traced KiB':>11s}")
+        for fname in args.saves:
+            for name, res in bench_decode_memory(fname).items():
+                print(f"{fname[-40:]:40s} {name:8s} {res['rss']:13d} {res['peak'] / 1024:11.0f}")
+    if args.paths:
+        for fname in args.saves:
+            res = bench_paths(fname, args.repeat)
+            print(f"{fname[-40:]:40s} HEADERS of 1000 saves, ms: " +
+                  ", ".join(f"{_k} {_v * 1000:.2f}" for _k, _v in res.items()))
+    if args.trace:
+        with open(args.trace, 'w', newline='') as _fh:
+            writer = csv.writer(_fh)
+            writer.writerow(['file', 'type', 'record', 'offset', 'size', 'class'])
+            for fname in args.saves:
+                write_trace(fname, writer)
+
+
+if __name__ == "__main__":
+    main()
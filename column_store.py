@@ -0,0 +1,118 @@
+"""Columnar store of the HEADERS rows extracted from save files
+
+The store is a directory holding one raw little endian file per column, the
+list of saves the rows came from and a manifest with the column types and
+the number of rows.  Rows are kept sorted by the sort column (playtime):
+new saves, normally later than everything stored, are appended to the
+column files and only out of order rows cause the columns to be rewritten.
+"""
+import json
+import logging
+import os
+import numpy as np
+
+MANIFEST = 'columns.json'
+PATHS = 'paths.txt'
+
+LOG = logging.getLogger()
+
+
+class ColumnStore:
+    def __init__(self, path, headers, sort_key='playtime'):
+        self.path = path
+        self.headers = list(headers)
+        self.sort_key = sort_key if sort_key in self.headers else self.headers[0]
+        self.dtypes = {}
+        self.rows = 0
+        self.paths = []
+        self.paths_size = 0
+        os.makedirs(path, exist_ok=True)
+        manifest = self.read_manifest()
+        if manifest and manifest['headers'] == self.headers:
+            self.dtypes = manifest['dtypes']
+            self.rows = manifest['rows']
+            self.paths_size = manifest['paths_size']
+            with open(self.filename(PATHS), 'rb') as _fh:
+                self.paths = _fh.read(self.paths_size).decode('utf8').splitlines()
+        elif manifest:
+            LOG.warning("HEADERS changed, starting a new column store in %s", path)
+        self.known = set(self.paths)
+
+    def filename(self, name):
+        return os.path.join(self.path, name)
+
+    def column_file(self, header):
+        return self.filename(header + '.bin')
+
+    def read_manifest(self):
+        try:
+            with open(self.filename(MANIFEST)) as _fh:
+                return json.load(_fh)
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self):
+        tmpname = self.filename(MANIFEST + '.tmp')
+        with open(tmpname, 'w') as _fh:
+            json.dump({'headers': self.headers, 'dtypes': self.dtypes, 'rows': self.rows,
+                       'paths_size': self.paths_size}, _fh)
+        os.replace(tmpname, self.filename(MANIFEST))
+
+    def __contains__(self, fname):
+        return os.path.abspath(fname) in self.known
+
+    def new_saves(self, saves):
+        """Return the saves that are not in the store yet"""
+        return [_f for _f in saves if os.path.abspath(_f) not in self.known]
+
+    def column(self, header):
+        """Return one column, only rows listed in the manifest are read"""
+        if not self.rows:
+            return np.array([], dtype=self.dtypes.get(header, '<f8'))
+        return np.fromfile(self.column_file(header), self.dtypes[header], self.rows)
+
+    def load(self):
+        """Return {header: column} sorted by the sort column"""
+        return {_h: self.column(_h) for _h in self.headers}
+
+    def append(self, saves, rows):
+        """Add the HEADERS rows extracted from saves"""
+        if not rows:
+            return
+        rewrite = False
+        dtypes = {}
+        columns = {}
+        for header, values in zip(self.headers, zip(*rows)):
+            ints = all(isinstance(_v, int) and not isinstance(_v, bool) for _v in values)
+            dtypes[header] = '<i8' if ints and self.dtypes.get(header, '<i8') == '<i8' else '<f8'
+            if header in self.dtypes and dtypes[header] != self.dtypes[header]:
+                # an integer column got a float (or missing) value
+                rewrite = True
+            columns[header] = np.array([np.nan if _v is None else _v for _v in values], dtypes[header])
+        paths = np.array([os.path.abspath(_f) for _f in saves], dtype=object)
+        order = np.argsort(columns[self.sort_key], kind='stable')
+        if self.rows:
+            last = self.column(self.sort_key)[-1]
+            rewrite = rewrite or columns[self.sort_key][order[0]] < last
+        if rewrite:
+            columns = {_h: np.concatenate([self.column(_h).astype(dtypes[_h]), _c])
+                       for _h, _c in columns.items()}
+            paths = np.concatenate([np.array(self.paths, dtype=object), paths])
+            order = np.argsort(columns[self.sort_key], kind='stable')
+        self.dtypes = dtypes
+        mode = 'wb' if rewrite else 'ab'
+        for header, values in columns.items():
+            with open(self.column_file(header), mode) as _fh:
+                # drop anything written after the last manifest update
+                _fh.truncate(0 if rewrite else self.rows * values.itemsize)
+                values[order].tofile(_fh)
+        paths = paths[order].tolist()
+        data = ''.join(_p + '\n' for _p in paths).encode('utf8')
+        self.paths_size = len(data) if rewrite else self.paths_size + len(data)
+        with open(self.filename(PATHS), mode) as _fh:
+            _fh.truncate(self.paths_size - len(data))
+            _fh.write(data)
+        self.paths = paths if rewrite else self.paths + paths
+        self.known.update(paths)
+        self.rows = len(self.paths)
+        self.write_manifest()
@@ -1,49 +1,210 @@
+import array
 import struct
-import copy
+import functools
 import logging
 
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for primarr_view and array columns
+    np = None
+
 LOG = logging.getLogger()
 
 SEPARATOR = '/'
 
+# Precompiled little-endian codecs.  unpack_from() reads straight out of the
+# memoryview, so primitive reads never slice (and so never copy) the buffer.
+U32 = struct.Struct('<L')
+I32 = struct.Struct('<l')
+U64 = struct.Struct('<Q')
+I64 = struct.Struct('<q')
+FLOAT = struct.Struct('<f')
+DOUBLE = struct.Struct('<d')
+
+# NRBF primitive type code -> struct format character
+PRIM_FORMATS = {
+    1: 'B',  # bool
+    6: 'd',  # Double
+    8: 'l',  # int32
+    9: 'q',  # int64
+    11: 'f',  # float
+}
+PRIM_CODECS = {_k: struct.Struct('<' + _v) for _k, _v in PRIM_FORMATS.items()}
+# NRBF primitive type code -> numpy dtype, for primitive array views
+PRIM_DTYPES = {1: '|u1', 6: '<f8', 8: '<i4', 9: '<i8', 11: '<f4'}
+
+
+# Record type byte -> name, for structured traces
+RECORD_TYPES = {
+    1: 'ClassWithId',
+    4: 'SystemClassWithMembersAndTypes',
+    5: 'ClassWithMembersAndTypes',
+    7: 'BinaryArray',
+    15: 'ArraySinglePrimitive',
+}
+
+# Deserializer.iter_events() event kinds
+CLASS_START = 'class_start'
+FIELD = 'field'
+REFERENCE = 'reference'
+ARRAY_START = 'array_start'
+END = 'end'
+
+# Projection marker for records/fields that are walked but not materialized
+SKIP = object()
+
+
+@functools.lru_cache(maxsize=None)
+def prim_struct(primtypes):
+    """Return a single Struct decoding a run of primitive type codes"""
+    return struct.Struct('<' + ''.join(PRIM_FORMATS[_t] for _t in primtypes))
+
+
+def compile_projection(paths):
+    """Turn DictQuery-style paths into a field-name tree
+
+    'value' components are dropped since every field wraps its payload in a
+    'value' key, and arrays are transparent (their elements share the array's
+    subtree).  A None node selects the whole subtree.
+    """
+    tree = {}
+    for path in paths:
+        keys = [_k for _k in path.split(SEPARATOR) if _k and _k != 'value']
+        if not keys:
+            return None
+        node = tree
+        for key in keys[:-1]:
+            if key in node and node[key] is None:
+                break
+            node = node.setdefault(key, {})
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
+def merge_projection(first, second):
+    """Union of two projection subtrees"""
+    if first is SKIP:
+        return second
+    if second is SKIP:
+        return first
+    if first is None or second is None:
+        return None
+    merged = dict(first)
+    for key, sub in second.items():
+        merged[key] = merge_projection(merged[key], sub) if key in merged else sub
+    return merged
+
 
 class UnhandledData(Exception):
     pass
 
 
 class Deserializer:
-    def __init__(self, data, pos=0):
-        self.data = data
+    """Parse a .NET BinaryFormatter (NRBF) stream
+
+    projection is an optional list of DictQuery paths relative to the first
+    (root) record, e.g. ['adventure/value/attack', 'inventory'].  When given,
+    only the selected fields and the objects they reference are built;
+    everything else is skipped over without creating Python objects.
+
+    Instead of parse(), scan() can be used to only index the top-level records;
+    get() then returns a LazyRecord that parses records as paths touch them.
+
+    Primitive arrays are decoded into lists by default (JSON friendly).  With
+    primarr_view=True they are returned as read-only numpy arrays viewing the
+    input buffer instead, which requires numpy.
+
+    compact=True stores objects as CompactRecords (a values list sharing the
+    class layout) instead of a dict of {'type', 'code', 'value'} dicts.  Paths
+    and indexing work the same; pass json_default to json.dumps to export.
+
+    Hex dumps and per-field debug lines are only built when the logger has
+    DEBUG enabled at construction time.  trace_records=True additionally
+    collects (record type, offset, size, class name) for every record into
+    self.records.
+    """
+    def __init__(self, data, pos=0, projection=None, primarr_view=False, trace_records=False,
+                 compact=False):
+        if primarr_view and np is None:
+            raise ImportError("primarr_view requires numpy")
+        self.data = memoryview(data)
+        self.primarr_view = primarr_view
+        self.compact = compact
+        self.trace = LOG.isEnabledFor(logging.DEBUG)
+        self.records = [] if trace_records else None
         self.pos = pos
         self.idmap = {}
         self.meta = {}
-        self.seen = set()
-        self.printhex(10)
+        self.decoders = {}
+        # (container, key, object id) of every deferred reference, see _finalize
+        self.slots = []
+        self.projection = compile_projection(projection) if projection is not None else None
+        # projection bookkeeping: id -> wanted subtree / subtree parsed / record offset
+        self.want = {}
+        self.done = {}
+        self.offsets = {}
+        self.pending = []
+        # class name -> {object id: None}, an insertion ordered set
+        self.classes = {}
+        # set by scan() for lazy materialization
+        self.index = None
+        self.lazy_refs = {}
+        if self.trace:
+            self.printhex(10)
 
     def get(self, name):
-        obj = next(_ for _ in self.idmap.values()
-                   if isinstance(_, dict) and _.get('__cname__') == name)
+        """First object of class `name`"""
+        return self._query(next(iter(self.classes.get(name, ()))))
+
+    def get_all(self, name):
+        """All objects of class `name` in parse order
+
+        After a projected parse or scan() only the objects built so far are
+        known, skipped records are not counted.
+        """
+        return [self._query(_id) for _id in self.classes.get(name, ())]
+
+    def count(self, name):
+        """Number of objects of class `name`, see get_all"""
+        return len(self.classes.get(name, ()))
+
+    def _query(self, _id):
+        # objects nested inline in a materialized record are not in the index
+        if self.index is not None and _id in self.index.rows:
+            return self.lazy_ref(_id)
+        obj = self.idmap[_id]
+        # projected parses build dicts even in compact mode
+        if isinstance(obj, CompactRecord):
+            return obj
         return DictQuery(obj)
 
     def parse(self):
         ret = []
+        if self.projection is not None:
+            self.want[self.peek_id()] = self.projection
         while True:
             _type = self.data[self.pos]
+            proj = None
+            if self.projection is not None and _type in (1, 4, 5, 7, 15):
+                proj = self.want.get(self.peek_id(), SKIP)
             try:
                 if _type == 1:  # Ref object
-                    ret.append(self.parse_refobj())
+                    res = self.parse_refobj(proj)
                 elif _type == 4:  # Runtime Obj
-                    ret.append(self.parse_class())
+                    res = self.parse_class(proj)
                 elif _type == 5:  # Class 
-                    ret.append(self.parse_class())
+                    res = self.parse_class(proj)
                 elif _type == 7:  # Generic Array
-                    ret.append(self.parse_generic_array())
+                    res = self.parse_generic_array(proj)
                 elif _type == 10:  # NullValue
                     self.pos += 1
+                    continue
                 elif _type == 15:  # Array of primitives
-                    ret.append(self.parse_primarr())
+                    res = self.parse_primarr(proj)
                 elif _type == 11:  # END
-                    LOG.debug(f"Found end")
+                    if self.trace:
+                        LOG.debug("Found end")
                     break
                 else:
                     LOG.error(f"Stopping on {_type}")
@@ -53,42 +214,235 @@ class Deserializer:
             finally:
                 # self.printhex(40)
                 pass
+            if proj is not SKIP:
+                ret.append(res)
+        self._parse_pending()
         self._finalize()
         return ret
 
-    def _finalize(self):
-        for _id in self.idmap:
-            self._fix_deferred_id(_id)
-
-    def _fix_deferred_id(self, _id):
-        if _id not in self.seen:
-            self.seen.add(_id)
-            if isinstance(self.idmap[_id], list):
-                for _idx, _val in enumerate(self.idmap[_id]):
-                    if isinstance(_val, (list, tuple)) and _val[-1] == 'deferred':
-                        self._fix_deferred_id(_val[0])
-                        self.idmap[_id][_idx] = self.idmap[_val[0]]
-            self._fix_deferred_dict(self.idmap[_id])
-
-    def _fix_deferred_dict(self, item):
-        if not isinstance(item, dict):
-            return
-        for key, ref in item.items():
-            if key.startswith('__'):
-                continue
-            if key == 'deferred':
-                continue
-            if key == 'value' and isinstance(ref, list):
-                for _idx, _val in enumerate(ref):
-                    if isinstance(_val, (list, tuple)) and _val[-1] == 'deferred':
-                        self._fix_deferred_id(_val[0])
-                        ref[_idx] = self.idmap[_val[0]]
+    def iter_events(self):
+        """Yield (kind, name, value) events for the records, without building them
+
+        No idmap is kept (only class metadata), so memory use does not grow
+        with the size of the save.  name is the field holding the value (None
+        for top-level records and array elements):
+
+          ('class_start', name, (class name, id))
+          ('field', name, value)        primitive, string or null
+          ('reference', name, id)       reference to an object stored elsewhere
+          ('array_start', name, (id, length))
+          ('end', None, None)           closes a class_start or array_start
+
+        For example the highest 'level' field anywhere in a save:
+          max(_v for _k, _n, _v in des.iter_events() if _k == FIELD and _n == 'level')
+        """
+        while True:
+            _type = self.data[self.pos]
+            try:
+                if _type in (1, 4, 5, 7, 15):
+                    yield from self._record_events(None)
+                elif _type == 10:  # NullValue
+                    self.pos += 1
+                elif _type == 11:  # END
+                    break
+                else:
+                    LOG.error(f"Stopping on {_type}")
+                    break
+            except UnhandledData:
+                break
+
+    def _record_events(self, name):
+        _type = self.data[self.pos]
+        if _type in (1, 4, 5):
+            if _type == 1:
+                self.pos += 1
+                _id = self.read_u32()
+                metaid = self.read_u32()
+            else:
+                _id = metaid = self.parse_class_header()
+            decoder = self.decoders.get(metaid)
+            if decoder is None:
+                LOG.error(f"Couldn't find meta-id {metaid}")
+                raise UnhandledData
+            yield CLASS_START, name, (decoder.cname, _id)
+            for codec, field, type_tag, code in decoder.steps:
+                if codec is not None:
+                    for (_name, _), value in zip(field, self.read_struct(codec)):
+                        yield FIELD, _name, value
+                else:
+                    yield from self._value_events(type_tag, code, field)
+        elif _type == 7:
+            _id, length, type_tag, type_spec = self.parse_generic_array_header()
+            yield ARRAY_START, name, (_id, length)
+            count = 0
+            while count < length:
+                count += yield from self._value_events(type_tag, type_spec, None)
+        elif _type == 15:
+            self.pos += 1
+            _id = self.read_u32()
+            length = self.read_u32()
+            primtype = self.read_byte()
+            yield ARRAY_START, name, (_id, length)
+            codec = PRIM_CODECS.get(primtype)
+            if codec is None:
+                for _ in range(length):
+                    yield FIELD, None, self.get_prim_value(primtype)
+            else:
+                end = self.pos + length * codec.size
+                for value, in codec.iter_unpack(self.data[self.pos:end]):
+                    yield FIELD, None, value
+                self.pos = end
+        else:
+            LOG.error(f"Unsupported data type: {_type}")
+            raise UnhandledData
+        yield END, None, None
+
+    def _value_events(self, type_tag, type_spec, name):
+        """Events for one field/element value, returns the number of elements read"""
+        if type_tag in (3, 4, 7) and self.data[self.pos] in (1, 4, 5):
+            yield from self._record_events(name)
+            return 1
+        _id, value = self.get_single_value(type_tag, type_spec, name)
+        if value == 'deferred':
+            yield REFERENCE, name, _id
+        elif isinstance(value, list):  # run of nulls
+            for _ in value:
+                yield FIELD, name, None
+            return len(value)
+        else:
+            yield FIELD, name, value
+        return 1
+
+    def peek_id(self):
+        """Object id of the record starting at the current position"""
+        return U32.unpack_from(self.data, self.pos + 1)[0]
+
+    def request(self, _id, proj):
+        """Mark object _id as needed with projection subtree proj"""
+        merged = merge_projection(self.want.get(_id, SKIP), proj)
+        self.want[_id] = merged
+        if _id in self.done and self.done[_id] != merged:
+            # already parsed (or skipped) with a narrower projection
+            self.pending.append(_id)
+
+    def _store(self, _id, orig_pos, proj, value, cname=None):
+        if self.records is not None:
+            self.records.append((self.data[orig_pos], orig_pos, self.pos - orig_pos, cname))
+        if self.projection is not None:
+            self.offsets[_id] = orig_pos
+            self.done[_id] = proj
+        if proj is SKIP:
+            return None
+        if cname is not None:
+            self.classes.setdefault(cname, {})[_id] = None
+        self.idmap[_id] = value
+        return value
+
+    def parse_record(self, proj=None):
+        """Parse the object/array record at the current position"""
+        _type = self.data[self.pos]
+        if _type == 1:
+            return self.parse_refobj(proj)
+        elif _type in (4, 5):
+            return self.parse_class(proj)
+        elif _type == 7:
+            return self.parse_generic_array(proj)
+        elif _type == 15:
+            return self.parse_primarr(proj)
+        LOG.error(f"Unsupported data type: {_type}")
+        raise UnhandledData
+
+    def scan(self):
+        """Index the top-level records without building them
+
+        Records are skipped over (class metadata is still collected) and
+        (id, meta id, offset, length) is stored in self.index.  Use get() or
+        materialize() afterwards to build records on demand.  Objects nested
+        inline in other records only show up in the class index (get_all,
+        count) once their parent has been materialized.
+        """
+        self.index = RecordIndex()
+        while True:
+            _type = self.data[self.pos]
+            start = self.pos
+            if _type in (1, 4, 5, 7, 15):
+                _id = self.peek_id()
+                if _type == 1:
+                    metaid = U32.unpack_from(self.data, self.pos + 5)[0]
+                elif _type in (4, 5):
+                    metaid = _id
+                else:
+                    metaid = -1
+                try:
+                    self.parse_record(SKIP)
+                except UnhandledData:
+                    break
+                self.index.add(_id, metaid, start, self.pos - start)
+                if metaid != -1:
+                    self.classes.setdefault(self.meta[metaid]['__cname__'], {})[_id] = None
+            elif _type == 10:  # NullValue
+                self.pos += 1
+            elif _type == 11:  # END
+                break
+            else:
+                LOG.error(f"Stopping on {_type}")
+                break
+        return self.index
+
+    def materialize(self, _id):
+        """Build a scanned record, leaving its references as LazyRecords"""
+        if _id in self.idmap:
+            return self.idmap[_id]
+        end = self.pos
+        self.pos = self.index.offsets[self.index.rows[_id]]
+        value = self.parse_record()
+        self.pos = end
+        # resolving can materialize arrays, which collect their own slots
+        slots, self.slots = self.slots, []
+        for container, key, ref in slots:
+            if isinstance(container, dict):
+                container[key] = LazyField(self, container[key])
+            else:
+                container[key] = self.lazy_ref(ref)
+        return value
+
+    def lazy_ref(self, _id):
+        """Value for a reference to _id: arrays are built now, objects on access"""
+        if self.index.metaids[self.index.rows[_id]] == -1:
+            return self.materialize(_id)
+        if _id not in self.lazy_refs:
+            self.lazy_refs[_id] = LazyRecord(self, _id)
+        return self.lazy_refs[_id]
+
+    def _parse_pending(self):
+        """Re-read records that were skipped before a reference to them was seen"""
+        end = self.pos
+        while self.pending:
+            _id = self.pending.pop()
+            proj = self.want[_id]
+            if self.done[_id] == proj:
                 continue
-            self._fix_deferred_dict(ref)
-        if 'deferred' in item:
-            self._fix_deferred_id(item['deferred'])
-            item['value'] = self.idmap[item['deferred']]
-            del item['deferred']
+            self.pos = self.offsets[_id]
+            self.parse_record(proj)
+        self.pos = end
+
+    def _finalize(self):
+        """Replace deferred references with the objects they point to
+
+        Every reference was recorded as a (container, key, id) slot while
+        parsing, so this is a single pass over the references.  Dict slots
+        hold a field ({'type', 'code', 'deferred'}), list slots an array
+        element.
+        """
+        idmap = self.idmap
+        for container, key, _id in self.slots:
+            if isinstance(container, dict):
+                field = container[key]
+                field['value'] = idmap[_id]
+                del field['deferred']
+            else:
+                container[key] = idmap[_id]
+        self.slots = []
 
     def read_byte(self, peek=False):
         ret = self.data[self.pos]
@@ -99,7 +453,6 @@ class Deserializer:
     def read_str(self):
         size = 0
         shift = 0
-        origpos = self.pos
         while True:
             _siz = self.data[self.pos]
             self.pos += 1
@@ -107,37 +460,54 @@ class Deserializer:
             shift += 7
             if _siz < 128:
                 break
-        ret = self.data[self.pos: self.pos + size].decode('utf8')
+        ret = str(self.data[self.pos: self.pos + size], 'utf8')
         self.pos += size
         return ret
 
+    def skip_str(self):
+        size = 0
+        shift = 0
+        while True:
+            _siz = self.data[self.pos]
+            self.pos += 1
+            size = size + ((0x7f & _siz) << shift)
+            shift += 7
+            if _siz < 128:
+                break
+        self.pos += size
+
+    def read_struct(self, codec):
+        res = codec.unpack_from(self.data, self.pos)
+        self.pos += codec.size
+        return res
+
     def read_u32(self):
-        res = struct.unpack('<L', self.data[self.pos:self.pos + 4])
+        res = U32.unpack_from(self.data, self.pos)
         self.pos += 4
         return res[0]
 
     def read_i32(self):
-        res = struct.unpack('<l', self.data[self.pos:self.pos + 4])
+        res = I32.unpack_from(self.data, self.pos)
         self.pos += 4
         return res[0]
 
     def read_u64(self):
-        res = struct.unpack('<Q', self.data[self.pos:self.pos + 8])
+        res = U64.unpack_from(self.data, self.pos)
         self.pos += 8
         return res[0]
 
     def read_i64(self):
-        res = struct.unpack('<q', self.data[self.pos:self.pos + 8])
+        res = I64.unpack_from(self.data, self.pos)
         self.pos += 8
         return res[0]
 
     def read_float(self):
-        res = struct.unpack('<f', self.data[self.pos:self.pos + 4])
+        res = FLOAT.unpack_from(self.data, self.pos)
         self.pos += 4
         return res[0]
 
     def read_double(self):
-        res = struct.unpack('<d', self.data[self.pos:self.pos + 8])
+        res = DOUBLE.unpack_from(self.data, self.pos)
         self.pos += 8
         return res[0]
 
@@ -156,7 +526,14 @@ class Deserializer:
             LOG.debug(f"{start:08x}    " + " ".join(_hex) + "    " + "".join(_str))
             start += 16
 
-    def parse_class(self):
+    def parse_class(self, proj=None):
+        orig_pos = self.pos
+        _id = self.parse_class_header()
+        value = self.get_class_values(_id, proj)
+        return self._store(_id, orig_pos, proj, value, self.decoders[_id].cname)
+
+    def parse_class_header(self):
+        """Read a class record's metadata, compile its decoder and return its id"""
         orig_pos = self.pos
         elem_type = self.read_byte()
         if elem_type not in (4, 5):
@@ -165,7 +542,8 @@ class Deserializer:
         _id = self.read_u32()
         cname = self.read_str()
         count = self.read_u32()
-        LOG.debug(f"{cname}({_id}) @ {orig_pos:04x} Count: {count}")
+        if self.trace:
+            LOG.debug(f"{cname}({_id}) @ {orig_pos:04x} Count: {count}")
         cls_idx = []
         cls = {}
         while count:
@@ -177,18 +555,20 @@ class Deserializer:
         for name in cls_idx:
             type_tag = cls[name]['type']
             cls[name]['code'] = self.get_type_spec(type_tag)
-        self.printhex(30)
+        if self.trace:
+            self.printhex(30)
         cls['__cname__'] = cname
         cls['__fields__'] = cls_idx
         self.meta[_id] = cls
+        self.decoders[_id] = ClassDecoder(cls)
         if elem_type == 5:
             # only classes have assembly id
             assemblyid = self.read_u32()
-        self.printhex(orig_pos, self.pos)
-        self.idmap[_id] = self.get_class_values(_id)
-        return self.idmap[_id]
+        if self.trace:
+            self.printhex(orig_pos, self.pos)
+        return _id
 
-    def parse_refobj(self):
+    def parse_refobj(self, proj=None):
         orig_pos = self.pos
         if self.data[self.pos] != 1:
             LOG.error(f"Unsupported data type: {self.data[self.pos]}")
@@ -196,10 +576,10 @@ class Deserializer:
         self.pos += 1
         _id = self.read_u32()
         metaid = self.read_u32()
-        self.idmap[_id] = self.get_class_values(metaid)
-        return self.idmap[_id]
+        value = self.get_class_values(metaid, proj)
+        return self._store(_id, orig_pos, proj, value, self.decoders[metaid].cname)
 
-    def parse_primarr(self):
+    def parse_primarr(self, proj=None):
         orig_pos = self.pos
         if self.data[self.pos] != 15:
             LOG.error(f"Unsupported data type: {self.data[self.pos]}")
@@ -208,15 +588,46 @@ class Deserializer:
         _id = self.read_u32()
         count = self.read_u32()
         _type = self.read_byte()
-        ret = []
-        while count:
-            ret.append(self.get_prim_value(_type))
-            count -= 1
-        self.idmap[_id] = ret
-        return self.idmap[_id]
+        if _type not in PRIM_CODECS:
+            ret = []
+            while count:
+                ret.append(self.get_prim_value(_type))
+                count -= 1
+            return self._store(_id, orig_pos, proj, ret)
+        start = self.pos
+        self.pos += count * PRIM_CODECS[_type].size
+        if proj is SKIP:
+            ret = None
+        elif self.primarr_view:
+            ret = np.frombuffer(self.data, dtype=PRIM_DTYPES[_type], count=count, offset=start)
+            ret.flags.writeable = False
+        else:
+            ret = list(struct.unpack_from(f"<{count}{PRIM_FORMATS[_type]}", self.data, start))
+        return self._store(_id, orig_pos, proj, ret)
 
-    def parse_generic_array(self):
+    def parse_generic_array(self, proj=None):
         orig_pos = self.pos
+        _id, length, type_tag, type_spec = self.parse_generic_array_header()
+        ret = []
+        count = 0
+        while count < length:
+            res = self.get_single_value(type_tag, type_spec, "unknown", proj)
+            if isinstance(res[1], list):
+                count += len(res[1])
+                if proj is not SKIP:
+                    ret += [[res[0], _x] for _x in res[1]]
+            else:
+                count += 1
+                if proj is not SKIP:
+                    if res[1] == 'deferred':
+                        self.slots.append((ret, len(ret), res[0]))
+                        if self.projection is not None:
+                            self.request(res[0], proj)
+                    ret += [res]
+        return self._store(_id, orig_pos, proj, ret)
+
+    def parse_generic_array_header(self):
+        """Return (id, length, element type tag, element type spec)"""
         if self.data[self.pos] != 7:
             LOG.error(f"Unsupported data type: {self.data[self.pos]}")
             raise UnhandledData
@@ -232,15 +643,7 @@ class Deserializer:
             elems_per_dim.append(self.read_u32())
         type_tag = self.read_byte()
         type_spec = self.get_type_spec(type_tag)
-        ret = []
-        while len(ret) < elems_per_dim[0]:
-            res = self.get_single_value(type_tag, type_spec, "unknown")
-            if isinstance(res[1], list):
-                ret += [[res[0], _x] for _x in res[1]]
-            else:
-                ret += [res]
-        self.idmap[_id] = ret
-        return self.idmap[_id]
+        return _id, elems_per_dim[0], type_tag, type_spec
 
     def parse_runtime_obj(self):
         LOG.error("parse_runtime_obj unsupported")
@@ -278,21 +681,15 @@ class Deserializer:
             raise UnhandledData
 
     def get_prim_value(self, primtype):
-        if primtype == 1:  # bool
-            return self.read_byte()
-        elif primtype == 6:  # Double
-            return self.read_double()
-        elif primtype == 8:  # int32
-            return self.read_i32()
-        elif primtype == 9:  # int64
-            return self.read_i64()
-        elif primtype == 11:  # float
-            return self.read_float()
-        else:
+        codec = PRIM_CODECS.get(primtype)
+        if codec is None:
             LOG.error(f"Can't handle prim type '{primtype}'")
             raise UnhandledData
+        res = codec.unpack_from(self.data, self.pos)
+        self.pos += codec.size
+        return res[0]
 
-    def get_single_value(self, type_tag, type_spec, name):
+    def get_single_value(self, type_tag, type_spec, name, proj=None):
         if type_tag == 0:  # primitive
             return None, self.get_prim_value(type_spec)
         elif type_tag == 1:  # string
@@ -301,31 +698,34 @@ class Deserializer:
                 raise UnhandledData
             self.pos += 1
             _id = self.read_u32()
+            if proj is SKIP:
+                self.skip_str()
+                return _id, None
             return _id, self.read_str()
         elif type_tag in (3, 4, 7):
             elem = self.data[self.pos]
             if elem == 1:  # reference of object
-                origpos = self.pos
-                LOG.debug(f"(1) {name} - {self.pos:02x}")
-                self.printhex(origpos, self.pos)
-                return None, self.parse_refobj()
+                if self.trace:
+                    LOG.debug(f"(1) {name} - {self.pos:02x}")
+                return None, self.parse_refobj(proj)
             elif elem == 4:  # runtime
-                origpos = self.pos
-                LOG.debug(f"(5) {name} - {origpos:02x}")
-                self.printhex(origpos, self.pos + 48)
-                return None, self.parse_class()
+                if self.trace:
+                    LOG.debug(f"(5) {name} - {self.pos:02x}")
+                    self.printhex(self.pos, self.pos + 48)
+                return None, self.parse_class(proj)
             elif elem == 5:  # class
-                origpos = self.pos
-                LOG.debug(f"(5) {name} - {origpos:02x}")
-                self.printhex(origpos, self.pos + 48)
-                return None, self.parse_class()
+                if self.trace:
+                    LOG.debug(f"(5) {name} - {self.pos:02x}")
+                    self.printhex(self.pos, self.pos + 48)
+                return None, self.parse_class(proj)
             elif elem == 9:  # object ref
                 self.pos += 1
                 _id = self.read_u32()
-                if _id in self.idmap:
-                    LOG.debug(f"Found object reference: {self.idmap[_id]} for {name}")
-                else:
-                    LOG.debug(f"Found deferred object reference '{_id}' for {name}")
+                if self.trace:
+                    if _id in self.idmap:
+                        LOG.debug(f"Found object reference: {self.idmap[_id]} for {name}")
+                    else:
+                        LOG.debug(f"Found deferred object reference '{_id}' for {name}")
                 return _id, "deferred"
             elif elem == 10:  # NullValue
                 self.pos += 1
@@ -345,40 +745,356 @@ class Deserializer:
             LOG.error(f"Couldn't handle type {type_tag} for {name}")
             raise UnhandledData
 
-    def get_class_values(self, metaid):
-        if metaid not in self.meta:
+    def get_class_values(self, metaid, proj=None):
+        decoder = self.decoders.get(metaid)
+        if decoder is None:
             LOG.error(f"Couldn't find meta-id {metaid}")
             raise UnhandledData
-        cls = copy.deepcopy(self.meta[metaid])
-        cls_idx = cls.pop('__fields__')
-        start = self.pos
-        for name in cls_idx:
+        if self.projection is None and proj is not SKIP:
+            if self.compact:
+                return decoder.decode_compact(self)
+            return decoder.decode(self)
+        return decoder.decode_projected(self, proj)
+
+
+class RecordIndex:
+    """Compact (object id, meta id, offset, length) table built by Deserializer.scan
+
+    Arrays have a meta id of -1.
+    """
+    def __init__(self):
+        self.ids = array.array('q')
+        self.metaids = array.array('q')
+        self.offsets = array.array('q')
+        self.lengths = array.array('q')
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, _id, metaid, offset, length):
+        self.rows[_id] = len(self.ids)
+        self.ids.append(_id)
+        self.metaids.append(metaid)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+
+class ClassDecoder:
+    """A class layout (parse_class metadata) compiled into a list of steps
+
+    Each run of consecutive primitive fields becomes one combined Struct read,
+    every other field is dispatched through Deserializer.get_single_value.
+    Instances are built directly from the steps instead of deep-copying the
+    metadata for every object.
+    """
+    def __init__(self, cls):
+        self.cname = cls['__cname__']
+        # field layout shared by the CompactRecords of this class
+        self.names = list(cls['__fields__'])
+        self.types = [cls[_name]['type'] for _name in self.names]
+        self.codes = [cls[_name]['code'] for _name in self.names]
+        self.positions = {_name: _idx for _idx, _name in enumerate(self.names)}
+        self.steps = []
+        run = []
+        for name in cls['__fields__']:
             _type = cls[name]['type']
-            LOG.debug(f"{name} -- {_type}")
-            _id, value = self.get_single_value(_type, cls[name]['code'], name)
+            code = cls[name]['code']
+            if _type == 0 and code in PRIM_FORMATS:
+                run.append((name, code))
+                continue
+            self._add_run(run)
+            run = []
+            self.steps.append((None, name, _type, code))
+        self._add_run(run)
+
+    def _add_run(self, run):
+        if run:
+            codec = prim_struct(tuple(_code for _, _code in run))
+            self.steps.append((codec, run, 0, None))
+
+    def decode(self, des):
+        cls = {}
+        for codec, name, _type, code in self.steps:
+            if codec is not None:
+                for (_name, _code), value in zip(name, des.read_struct(codec)):
+                    cls[_name] = {'type': 0, 'code': _code, 'value': value}
+                continue
+            if des.trace:
+                LOG.debug(f"{name} -- {_type}")
+            _id, value = des.get_single_value(_type, code, name)
+            if value == 'deferred':
+                cls[name] = {'type': _type, 'code': code, 'deferred': _id}
+                des.slots.append((cls, name, _id))
+            else:
+                cls[name] = {'type': _type, 'code': code, 'value': value}
+        cls['__cname__'] = self.cname
+        return cls
+
+    def decode_compact(self, des):
+        values = []
+        for codec, name, _type, code in self.steps:
+            if codec is not None:
+                values.extend(des.read_struct(codec))
+                continue
+            if des.trace:
+                LOG.debug(f"{name} -- {_type}")
+            _id, value = des.get_single_value(_type, code, name)
+            if value == 'deferred':
+                des.slots.append((values, len(values), _id))
+                value = None
+            values.append(value)
+        return CompactRecord(self, values)
+
+    def decode_projected(self, des, proj):
+        """Decode only the fields selected by proj, skipping the rest by size
+
+        References are registered with the deserializer so the objects they
+        point to are built with the matching projection subtree.
+        """
+        cls = {}
+        for codec, name, _type, code in self.steps:
+            if codec is not None:
+                if proj is SKIP or (proj is not None and not any(_name in proj for _name, _ in name)):
+                    des.pos += codec.size
+                    continue
+                for (_name, _code), value in zip(name, des.read_struct(codec)):
+                    if proj is None or _name in proj:
+                        cls[_name] = {'type': 0, 'code': _code, 'value': value}
+                continue
+            sub = proj if proj is SKIP or proj is None else proj.get(name, SKIP)
+            _id, value = des.get_single_value(_type, code, name, sub)
+            if sub is SKIP:
+                continue
             if value == 'deferred':
-                cls[name]['deferred'] = _id
+                des.request(_id, sub)
+                cls[name] = {'type': _type, 'code': code, 'deferred': _id}
+                des.slots.append((cls, name, _id))
             else:
-                cls[name]['value'] = value
+                cls[name] = {'type': _type, 'code': code, 'value': value}
+        if proj is SKIP:
+            return None
+        cls['__cname__'] = self.cname
         return cls
 
 
+@functools.lru_cache(maxsize=None)
+def split_path(path):
+    return tuple(path.split(SEPARATOR))
+
+
+class PathAccessor:
+    """A DictQuery path compiled once, to be applied to any number of trees
+
+    accessor(tree) returns the same as tree.get(path).  Plain key lookups are
+    tried first, the generic walk (through lists and missing or empty
+    values) only runs when one of them fails.
+    """
+    __slots__ = ('path', 'keys')
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = split_path(path)
+
+    def __call__(self, tree, default=None):
+        val = tree
+        try:
+            for key in self.keys:
+                val = val[key]
+        except (KeyError, TypeError, IndexError, ValueError):
+            return tree.get(self.path, default)
+        return val
+
+
+@functools.lru_cache(maxsize=None)
+def compile_path(path):
+    """Return the (cached) PathAccessor of path"""
+    return PathAccessor(path)
+
+
+def extract_columns(trees, paths, default=None):
+    """Return {path: column} of every path looked up in each tree
+
+    Columns are numpy arrays (object arrays if a value is missing) when numpy
+    is available and lists otherwise.
+    """
+    accessors = [compile_path(_p) for _p in paths]
+    columns = [[] for _ in accessors]
+    for tree in trees:
+        for column, accessor in zip(columns, accessors):
+            column.append(accessor(tree, default))
+    if np is not None:
+        columns = [np.array(_c) for _c in columns]
+    return dict(zip(paths, columns))
+
+
+def array_element(elem):
+    """Value of an object array element
+
+    Inline records and strings are (id, value) tuples and nulls [None, None]
+    lists; referenced objects (including other arrays) are stored as is.
+    """
+    if isinstance(elem, tuple) or (isinstance(elem, list) and len(elem) == 2
+                                   and elem[0] is None and elem[1] is None):
+        return elem[1]
+    return elem
+
+
+def walk_path(val, keys, default=None):
+    """Continue a DictQuery path lookup from val through the remaining keys"""
+    for key in keys:
+        if not isinstance(val, (dict, list, CompactRecord)) or not val:
+            break
+        if isinstance(val, list):
+            val = [array_element(v) for v in val]
+            val = [v.get(key, default) if isinstance(v, (dict, CompactRecord)) else None for v in val]
+        else:
+            val = val.get(key, default)
+    return val
+
+
+def unwrap(val):
+    """Return a copy of val without {'type', 'code', 'value'} field wrappers or __cname__ keys
+
+    Records become plain {field: value} dicts, fields their value and array
+    elements their value (see array_element), so null elements become None.
+    """
+    if isinstance(val, (dict, CompactRecord)):
+        if '__cname__' not in val and 'value' in val:
+            return unwrap(val['value'])
+        return {_k: unwrap(_v) for _k, _v in val.items() if _k != '__cname__'}
+    if isinstance(val, (list, tuple)):
+        return [unwrap(array_element(_v)) for _v in val]
+    return val
+
+
 class DictQuery(dict):
     # from https://www.haykranen.nl/2016/02/13/handling-complex-nested-dicts-in-python/
     def get(self, path, default=None):
-        keys = path.split(SEPARATOR)
-        val = None
+        keys = split_path(path)
+        return walk_path(dict.get(self, keys[0], default), keys[1:], default)
 
-        for key in keys:
-            if val:
-                if isinstance(val, list):
-                    val = [v.get(key, default) if v else None for v in val]
-                else:
-                    val = val.get(key, default)
-            else:
-                val = dict.get(self, key, default)
 
-            if not val:
-                break
+class CompactRecord:
+    """An object stored as a list of values sharing its class layout
 
-        return val
+    layout is the class's ClassDecoder.  Fields are returned as
+    {'type', 'code', 'value'} dicts built on access, so DictQuery paths and
+    item['field']['value'] indexing work as with the dict representation.
+    """
+    __slots__ = ('layout', 'values')
+
+    def __init__(self, layout, values):
+        self.layout = layout
+        self.values = values
+
+    def __getitem__(self, key):
+        if key == '__cname__':
+            return self.layout.cname
+        pos = self.layout.positions[key]
+        return {'type': self.layout.types[pos], 'code': self.layout.codes[pos],
+                'value': self.values[pos]}
+
+    def __contains__(self, key):
+        return key == '__cname__' or key in self.layout.positions
+
+    def __iter__(self):
+        yield from self.layout.names
+        yield '__cname__'
+
+    def __len__(self):
+        return len(self.layout.names) + 1
+
+    def __repr__(self):
+        return f"CompactRecord({self.layout.cname}, {self.values!r})"
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(_key, self[_key]) for _key in self]
+
+    def get(self, path, default=None):
+        keys = split_path(path)
+        val = self[keys[0]] if keys[0] in self else default
+        return walk_path(val, keys[1:], default)
+
+
+def json_default(obj):
+    """json.dumps(default=...) hook exporting CompactRecords like dict records"""
+    if isinstance(obj, CompactRecord):
+        return dict(obj.items())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class LazyRecord(DictQuery):
+    """DictQuery over a scanned record which is only parsed when first accessed
+
+    Code reading the dict through the C API without calling a method (e.g.
+    json.dumps without indent) sees an empty dict until the record is loaded.
+    """
+    def __init__(self, des, _id):
+        super().__init__()
+        self._des = des
+        self._id = _id
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            dict.update(self, self._des.materialize(self._id))
+        return self
+
+    def get(self, path, default=None):
+        self._load()
+        return super().get(path, default)
+
+    def __getitem__(self, key):
+        self._load()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self._load()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        if not self._loaded:
+            return f"{type(self).__name__}({self._id})"
+        return dict.__repr__(self)
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+
+class LazyField(LazyRecord):
+    """A field of a lazily built record holding a reference
+
+    The reference is only resolved (arrays built, objects wrapped in a
+    LazyRecord) when the field is accessed.
+    """
+    def __init__(self, des, field):
+        super().__init__(des, field['deferred'])
+        dict.update(self, field)
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            dict.__setitem__(self, 'value', self._des.lazy_ref(dict.pop(self, 'deferred')))
+        return self
@@ -92,7 +92,7 @@ def display_priority(stats, priority):
     print("  ".join([f"{_p}; {calc_priority(stats, _p)}" for _p in priorities]))
 
 
-def optimize(items, lock=None, priority_list=None, num_accs=None):
+def optimize(items, lock=None, priority_list=None, num_accs=None, max_gens=200, time_budget=None):
     locked = []
     best_loadout = []
     best_stats = None
@@ -122,7 +122,7 @@ def optimize(items, lock=None, priority_list=None, num_accs=None):
             if item:
                 locked.append(item)
     # filt_items = filter_items(items, [_[0] for _ in priority])
-    res = optimize_items(items.values(), locked, priority)
+    res = optimize_items(items.values(), locked, priority, max_gens=max_gens, time_budget=time_budget)
     return res
 
 
@@ -133,6 +133,10 @@ def main():
     parser.add_argument("--lock", nargs='+', type=int, help="enforce certain items be worn (by ID)")
     parser.add_argument("--list-stats", action='store_true', help="List available stats")
     parser.add_argument("--accessories", type=int, help="Override # of accessories")
+    parser.add_argument("--max-gens", type=int, default=200,
+                        help="Maximum number of generations of the genetic algorithm (default 200)")
+    parser.add_argument("--time-budget", type=float,
+                        help="Stop the genetic algorithm after this many seconds (over all stats)")
     args = parser.parse_args()
     if args.list_stats:
         show_stats()
@@ -142,12 +146,13 @@ def main():
             sav = json.load(_fh)
     except:
         try:
-            sav = read_savegame(args.infile)
+            sav = read_savegame(args.infile, lazy=True)
         except Exception as _e:
             logging.critical("Failed to read save_file: %s", _e)
             sys.exit(1)
     items = parse_items(sav)
-    loadout = optimize(items, args.lock, args.stat, num_accs=args.accessories)
+    loadout = optimize(items, args.lock, args.stat, num_accs=args.accessories,
+                       max_gens=args.max_gens, time_budget=args.time_budget)
     stats = calc_stats(loadout)
     print(stats)
     for priority in args.stat:
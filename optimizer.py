@@ -1,116 +1,451 @@
-import random
+import math
+import time
 import numpy as np
 from pymoo.model.problem import Problem
 from pymoo.model.crossover import Crossover
 from pymoo.model.mutation import Mutation
 from pymoo.model.sampling import Sampling
+from pymoo.model.termination import Termination
 from pymoo.algorithms.so_genetic_algorithm import GA
 
 from pymoo.optimize import minimize
 
 
 class SubsetProblem(Problem):
+    """Pick `max` items of each group, maximizing func
+
+    func(L, X) must accept a single boolean item mask as well as a population
+    of masks, one per row. The whole population is evaluated in one call
+    unless elementwise is set.
+    """
     def __init__(self,
                  L,
                  fixed,
                  groups,
                  func,
-                 unique=None
+                 unique=None,
+                 elementwise=False
                  ):
         nvar = len(L[0]) - fixed
-        super().__init__(n_var=len(L[0]), n_obj=1, n_constr=1, elementwise_evaluation=True)
+        super().__init__(n_var=len(L[0]), n_obj=1, n_constr=2, elementwise_evaluation=elementwise)
         self.L = L
         self.nvar = nvar
         self.groups = []
         self.func = func
         self.unique = unique
+        # item -> id incidence of the ids that more than one item has
+        self.duplicates = None
+        if unique is not None:
+            _, inverse, counts = np.unique(unique[0], return_inverse=True, return_counts=True)
+            shared = np.flatnonzero(counts > 1)
+            self.duplicates = (inverse[:, None] == shared[None, :]).astype(float)
         pos = fixed
         for grp in groups:
             self.groups.append((pos, grp[0], grp[1]))
             pos += grp[0]
         self.n_max = sum(_[1] for _ in groups)
 
+    def duplicate_count(self, x):
+        """Number of items selected in x whose id is already selected"""
+        if self.duplicates is None or not self.duplicates.shape[1]:
+            return np.zeros(x.shape[:-1])
+        return np.sum(np.maximum(x @ self.duplicates - 1, 0), axis=-1)
+
     def _evaluate(self, x, out, *args, **kwargs):
         out["F"] = - self.func(self.L, x)
-        unique = set()
-        all_unique = -1
-        if self.unique is not None:
-            for elem in self.unique[0, x]:
-                if elem in unique:
-                    all_unique = 1
-                    break
-                unique.add(elem)
-        out["G"] = [(self.n_max - np.sum(x)) > 0, all_unique]
+        if x.ndim == 1:
+            out["G"] = [(self.n_max - np.sum(x)) > 0, self.duplicate_count(x)]
+            return
+        out["F"] = out["F"][:, None]
+        count = (self.n_max - np.sum(x, axis=1)) > 0
+        out["G"] = np.column_stack([count, self.duplicate_count(x)])
+
+
+def random_subsets(rng, mask, n_select):
+    """Return a mask of n_select (per row) randomly chosen True entries of mask
+
+    Every row gets random keys, the entries outside mask sort last, and the
+    first n_select entries of each row are taken.
+    """
+    keys = rng.random(mask.shape)
+    keys[~mask] = 2
+    order = np.argsort(keys, axis=1)
+    chosen = np.take_along_axis(mask, order, axis=1)
+    chosen &= np.arange(mask.shape[1]) < np.reshape(n_select, (-1, 1))
+    res = np.zeros_like(mask)
+    np.put_along_axis(res, order, chosen, axis=1)
+    return res
 
 
 class MySampling(Sampling):
+    def __init__(self, rng=None):
+        super().__init__()
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     def _do(self, problem, n_samples, **kwargs):
         X = np.full((n_samples, len(problem.L[0])), False, dtype=bool)
-        for i in range(len(problem.L[0]) - problem.nvar):
-            X[:, i] = True
-        for k in range(n_samples):
-            arr = []
-            for grp in problem.groups:
-                arr.append(grp[0] + np.random.permutation(grp[1])[:grp[2]])
-            I = np.concatenate(arr)
-            X[k, I] = True
+        X[:, :len(problem.L[0]) - problem.nvar] = True
+        for start, count, max_n in problem.groups:
+            X[:, start:start + count] = random_subsets(self.rng, np.ones((n_samples, count), dtype=bool), max_n)
 
         return X
 
 
 class BinaryCrossover(Crossover):
-    def __init__(self):
+    def __init__(self, rng=None):
         super().__init__(2, 1)
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     def _do(self, problem, X, **kwargs):
-        n_parents, n_matings, n_var = X.shape
-
-        _X = np.full((self.n_offsprings, n_matings, problem.n_var), False)
-
-        for k in range(n_matings):
-            p1, p2 = X[0, k], X[1, k]
-            both_are_true = np.logical_and(p1, p2)
-            _X[0, k, both_are_true] = True
-            for start, count, max_n in problem.groups:
-                end = start + count
-                n_remaining = max_n - np.sum(both_are_true[start:end])
-                I = start + np.where(np.logical_xor(p1[start:end], p2[start:end]))[0]
-                S = I[np.random.permutation(len(I))][:n_remaining]
-                _X[0, k, S] = True
+        p1, p2 = X[0], X[1]
+        both_are_true = np.logical_and(p1, p2)
+        _X = both_are_true.copy()
+        for start, count, max_n in problem.groups:
+            end = start + count
+            n_remaining = max_n - np.sum(both_are_true[:, start:end], axis=1)
+            differ = np.logical_xor(p1[:, start:end], p2[:, start:end])
+            _X[:, start:end] |= random_subsets(self.rng, differ, n_remaining)
 
-        return _X
+        return _X[None, :, :]
 
 
 class MyMutation(Mutation):
+    def __init__(self, rng=None):
+        super().__init__()
+        self.rng = rng if rng is not None else np.random.default_rng()
+
     def _do(self, problem, X, **kwargs):
-        for i in range(X.shape[0]):
-            grp = problem.groups[random.randrange(len(problem.groups))]
-            X[i, :] = X[i, :]
-            is_false = grp[0] + np.where(np.logical_not(X[i, grp[0]:grp[0] + grp[1]]))[0]
-            is_true = grp[0] + np.where(X[i, grp[0]:grp[0] + grp[1]])[0]
-            X[i, np.random.choice(is_false)] = True
-            X[i, np.random.choice(is_true)] = False
+        # swap one selected item of a random group for an unselected one
+        mutated = self.rng.integers(len(problem.groups), size=X.shape[0])
+        for _g, (start, count, _) in enumerate(problem.groups):
+            rows = np.flatnonzero(mutated == _g)
+            grp = X[rows, start:start + count]
+            add = random_subsets(self.rng, ~grp, 1)
+            remove = random_subsets(self.rng, grp, 1)
+            X[rows, start:start + count] = (grp | add) & ~remove
 
         return X
 
 
-def run_optimizer(stats, offset, item_groups, func, unique=None):
-    problem = SubsetProblem(stats, offset, item_groups, func, unique=unique)
+class ConvergenceTermination(Termination):
+    """Stop the GA when the best loadout did not improve for `patience` generations
+
+    It also stops after max_gens generations or time_budget seconds,
+    whichever comes first; `reason` tells which one it was.
+    """
+    def __init__(self, max_gens=None, time_budget=None, patience=30):
+        super().__init__()
+        self.max_gens = max_gens
+        self.time_budget = time_budget
+        self.patience = patience
+        self.best = None
+        self.improved = 0
+        self.reason = None
+
+    def _do_continue(self, algorithm):
+        opt = algorithm.opt[0]
+        # less constraint violation first, then a better objective
+        best = (opt.CV[0], opt.F[0])
+        if self.best is None or best < self.best:
+            self.best = best
+            self.improved = algorithm.n_gen
+        if self.max_gens is not None and algorithm.n_gen >= self.max_gens:
+            self.reason = 'max generations'
+        elif self.time_budget is not None and time.time() - algorithm.start_time >= self.time_budget:
+            self.reason = 'time budget'
+        elif algorithm.n_gen - self.improved >= self.patience:
+            self.reason = 'converged'
+        return self.reason is None
+
+
+def population_size(item_groups, minimum=50, maximum=150):
+    """GA population size: twice the number of candidates per item to pick, summed over the groups
+
+    Capped by the number of different loadouts.
+    """
+    size = 2 * sum(count / max_n for count, max_n in item_groups)
+    space = math.prod(math.comb(count, max_n) for count, max_n in item_groups)
+    return int(min(max(size, minimum), maximum, space))
+
+
+# 'auto' uses the exact solver when there are at most EXACT_MAX_SPACE loadouts
+# made of the candidate items of each group (counted before any picks are
+# built, so larger problems fall back to the GA at no cost), and finding the
+# non-dominated picks never keeps more than EXACT_MAX_PICKS partial ones
+EXACT_MAX_SPACE = 10 ** 8
+EXACT_MAX_PICKS = 3000
+# partial loadouts the exact solver extends at a time
+EXACT_MERGE_CHUNK = 1 << 20
+
+
+def evaluate_sums(func, sums):
+    """Evaluate func for each column of stat sums
+
+    The objectives only see 1 + L @ x.T, so the sums are passed as an L
+    with a single item per column, all selected.
+    """
+    return func(sums[:, :, None], np.ones(1, dtype=bool))
+
+
+def pareto_front(P, keys, chunk=256):
+    """Indices of the rows of P no other row is as good as in every column
+
+    A row only drops another if its key (a bitmask of shared item ids) is a
+    subset of the other's, so it can complete every loadout the other can.
+    Rows are visited by decreasing sum, so only earlier rows can dominate
+    later ones and equal rows keep the first.
+    """
+    order = np.argsort(-P.sum(axis=1), kind='stable')
+    front = np.empty(0, dtype=int)
+
+    def dominates(A, akeys, B, bkeys):
+        res = (akeys[:, None] & ~bkeys[None]) == 0
+        for col in range(P.shape[1]):
+            res &= A[:, col, None] >= B[None, :, col]
+        return res
+
+    for pos in range(0, len(order), chunk):
+        idx = order[pos:pos + chunk]
+        C, ckeys = P[idx], keys[idx]
+        dominated = np.triu(dominates(C, ckeys, C, ckeys), 1).any(axis=0)
+        if len(front):
+            dominated |= dominates(P[front], keys[front], C, ckeys).any(axis=0)
+        front = np.concatenate([front, idx[~dominated]])
+    return np.sort(front)
+
+
+class ExactResult:
+    """Stands in for the pymoo result when the exact solver was used"""
+    def __init__(self, X, F, states, exec_time):
+        self.X = X
+        self.F = F
+        self.states = states
+        self.exec_time = exec_time
+
+
+class ExactSolver:
+    """Branch and bound over the groups, breadth first
+
+    func must be monotone in every stat it uses (see stats.monotone). Stats
+    are handled as signed sums, so larger is always better:
+
+    - within a group, an item that at least `max` items with a unique id are
+      as good as in every stat is never needed and dropped up front, and of
+      the ways to pick the items of a group only the non-dominated ones are
+      kept;
+    - after each group, partial loadouts that another one dominates are
+      dropped, as are those that can not beat the greedy loadout even if
+      every stat got the best remaining items (the monotone upper bound).
+    """
+    def __init__(self, L, fixed, groups, func, unique=None):
+        self.L = L
+        self.func = func
+        self.used = np.array(sorted(func.signs))
+        self.sign = np.array([func.signs[_i] for _i in self.used], dtype=float)
+        self.W = self.sign[:, None] * L[self.used]
+        self.fixed = fixed
+        ids = unique[0] if unique is not None else np.arange(L.shape[1])
+        _, inverse, counts = np.unique(ids, return_inverse=True, return_counts=True)
+        self.id_unique = counts[inverse] == 1
+        self.groups = []
+        pos = fixed
+        for count, max_n in groups:
+            self.groups.append((pos + self.candidates(pos, count, max_n), max_n))
+            pos += count
+        # bit of the shared id of each item left, 0 for unique ids
+        left = np.concatenate([np.arange(fixed)] + [cand for cand, _ in self.groups])
+        classes, left_counts = np.unique(inverse[left], return_counts=True)
+        shared = classes[left_counts > 1]
+        self.supported = len(shared) <= 64
+        self.keys = np.zeros(L.shape[1], dtype=np.uint64)
+        if self.supported:
+            for bit, cls in enumerate(shared):
+                self.keys[inverse == cls] = np.uint64(1 << bit)
+        self.picks = None
+        self.states = 0
+
+    def candidates(self, start, count, max_n):
+        """Positions in the group of the items that are not dominated"""
+        V = self.W[:, start:start + count]
+        ge = np.all(V[:, :, None] >= V[:, None, :], axis=0)
+        gt = np.any(V[:, :, None] > V[:, None, :], axis=0)
+        # ties are broken by position, so equal items do not drop each other
+        dominates = ge & (gt | np.triu(np.ones((count, count), dtype=bool), 1))
+        dominates &= self.id_unique[start:start + count, None]
+        return np.flatnonzero(np.sum(dominates, axis=0) < max_n)
+
+    def group_picks(self, cand, max_n, limit=None):
+        """(items, signed sums, keys) of the non-dominated ways to pick max_n of cand
+
+        Items are added in order, one at a time. Until the last one, a
+        partial pick only dominates another if its last item is not a later
+        one, as it must leave the other all of its choices. Returns None if
+        more than limit partial picks are left after a step.
+        """
+        items = np.empty((1, 0), dtype=int)
+        sums = np.zeros((1, len(self.used)))
+        keys = np.zeros(1, dtype=np.uint64)
+        for step in range(max_n):
+            last = items[:, -1] if step else np.full(1, -1)
+            extend = (last[:, None] < np.arange(len(cand))[None]) & ((keys[:, None] & self.keys[cand][None]) == 0)
+            state, item = np.nonzero(extend)
+            items = np.column_stack([items[state], item])
+            sums = sums[state] + self.W[:, cand[item]].T
+            keys = keys[state] | self.keys[cand[item]]
+            order = sums if step == max_n - 1 else np.column_stack([sums, -item])
+            front = pareto_front(order, keys)
+            items, sums, keys = items[front], sums[front], keys[front]
+            if limit is not None and len(items) > limit:
+                return None
+        return cand[items], sums, keys
+
+    def combinations(self):
+        """Number of loadouts made of the candidates of each group, an upper bound of space()"""
+        return math.prod(math.comb(len(cand), max_n) for cand, max_n in self.groups)
+
+    def space(self, limit=None):
+        """Number of loadouts made of the non-dominated picks of each group
+
+        inf if finding the picks of a group keeps more than limit partial ones.
+        """
+        if self.picks is None:
+            picks = []
+            for cand, max_n in self.groups:
+                picks.append(self.group_picks(cand, max_n, limit))
+                if picks[-1] is None:
+                    return math.inf
+            self.picks = picks
+        return math.prod(len(_p[0]) for _p in self.picks)
+
+    def value(self, sums):
+        """func of rows of signed sums"""
+        full = np.zeros((self.L.shape[0], len(sums)))
+        full[self.used] = self.sign[:, None] * sums.T
+        return evaluate_sums(self.func, full)
+
+    def solve(self):
+        """Return (x, value), x is None if no loadout has unique ids"""
+        self.space()
+        picks = self.picks
+        # best signed sums the groups after each group can add, stat by stat
+        tail = np.zeros((len(self.groups) + 1, len(self.used)))
+        for _g in range(len(self.groups) - 1, -1, -1):
+            tail[_g] = tail[_g + 1] + picks[_g][1].max(axis=0, initial=-np.inf)
+
+        def merge(group, sums, keys):
+            """Every loadout of sums extended by every pick of group, and its bound"""
+            _, psums, pkeys = picks[group]
+            merged = (sums[:, None] + psums[None]).reshape(-1, len(self.used))
+            mkeys = (keys[:, None] | pkeys[None]).ravel()
+            valid = ((keys[:, None] & pkeys[None]) == 0).ravel()
+            return merged, mkeys, valid, self.value(merged + tail[group + 1])
+
+        base = self.W[:, :self.fixed].sum(axis=1)[None]
+        base_key = np.bitwise_or.reduce(self.keys[:self.fixed], initial=np.uint64(0))[None]
+        # greedy loadout: the pick with the best bound, group by group
+        best = -np.inf
+        sums, keys = base, base_key
+        for group in range(len(self.groups)):
+            merged, mkeys, valid, bound = merge(group, sums, keys)
+            if not valid.any():
+                break
+            pick = np.flatnonzero(valid)[np.argmax(bound[valid])]
+            sums, keys = merged[pick:pick + 1], mkeys[pick:pick + 1]
+        else:
+            best = self.value(sums)[0]
+
+        sums, keys = base, base_key
+        parents = []
+        self.states = 1
+        for group in range(len(self.groups)):
+            count = len(picks[group][0])
+            chunk = max(1, EXACT_MERGE_CHUNK // max(count, 1))
+            kept, kept_sums, kept_keys = [], [], []
+            for pos in range(0, len(sums), chunk):
+                merged, mkeys, valid, bound = merge(group, sums[pos:pos + chunk], keys[pos:pos + chunk])
+                keep = np.flatnonzero(valid & (bound >= best - 1e-9 * abs(best)))
+                keep = keep[pareto_front(merged[keep], mkeys[keep])]
+                kept.append(keep + pos * count)
+                kept_sums.append(merged[keep])
+                kept_keys.append(mkeys[keep])
+            kept = np.concatenate(kept)
+            sums, keys = np.concatenate(kept_sums), np.concatenate(kept_keys)
+            if len(kept_sums) > 1:
+                front = pareto_front(sums, keys)
+                sums, keys, kept = sums[front], keys[front], kept[front]
+            parents.append(kept)
+            self.states += len(kept)
+            if not len(kept):
+                return None, None
+
+        state = int(np.argmax(self.value(sums)))
+        selected = list(range(self.fixed))
+        for group in range(len(self.groups) - 1, -1, -1):
+            state, pick = divmod(int(parents[group][state]), len(picks[group][0]))
+            selected.extend(picks[group][0][pick])
+        x = np.zeros(self.L.shape[1], dtype=bool)
+        x[selected] = True
+        return x, self.func(self.L, x)
+
+
+def exact_solver(L, fixed, groups, func, unique=None):
+    """Return an ExactSolver for the problem, or None if func can not be bounded"""
+    if not groups or not getattr(func, 'signs', None):
+        return None
+    solver = ExactSolver(L, fixed, groups, func, unique)
+    if not solver.supported:
+        return None
+    # products of the 1 + sum terms are only monotone while every term is >= 0
+    stats = L[solver.used]
+    worst = 1 + np.sum(np.minimum(stats[:, :fixed], 0), axis=1) + sum(
+        np.sort(np.minimum(stats[:, cand], 0), axis=1)[:, :max_n].sum(axis=1) for cand, max_n in solver.groups)
+    if np.any(worst < 0):
+        return None
+    return solver
+
+
+def run_optimizer(stats, offset, item_groups, func, unique=None, elementwise=False, seed=1,
+                  method='auto', max_gens=200, time_budget=None):
+    """Pick the items maximizing func
+
+    method is 'ga', 'exact' or 'auto', which solves exactly when func is
+    supported and the problem is small enough, falling back to the GA if the
+    exact search grows too large. The GA stops as ConvergenceTermination
+    says, after at most max_gens generations or time_budget seconds.
+    """
+    if method != 'ga':
+        start = time.perf_counter()
+        solver = exact_solver(stats, offset, item_groups, func, unique)
+        if solver is not None and (method == 'exact' or (solver.combinations() <= EXACT_MAX_SPACE and
+                                                         solver.space(EXACT_MAX_PICKS) <= EXACT_MAX_SPACE)):
+            x, value = solver.solve()
+            if x is not None:
+                res = ExactResult(x, np.array([-value]), solver.states, time.perf_counter() - start)
+                print("Function value: %s" % res.F[0])
+                print("Subset:", np.where(res.X)[0])
+                print(f"Solved exactly: {res.states} partial loadouts in {res.exec_time:.2f}s")
+                return np.where(res.X)[0], res
+        if method == 'exact':
+            raise ValueError("The exact solver can not be used for this problem")
+
+    problem = SubsetProblem(stats, offset, item_groups, func, unique=unique, elementwise=elementwise)
+    rng = np.random.default_rng(seed)
 
     # algorithm = NSGA2(
     algorithm = GA(
-        pop_size=stats.shape[1] - offset,
-        sampling=MySampling(),
-        crossover=BinaryCrossover(),
-        mutation=MyMutation(),
+        pop_size=population_size(item_groups),
+        sampling=MySampling(rng),
+        crossover=BinaryCrossover(rng),
+        mutation=MyMutation(rng),
         eliminate_duplicates=True)
 
     res = minimize(problem,
                    algorithm,
-                   ('n_gen', 60),
-                   seed=1,
+                   ConvergenceTermination(max_gens, time_budget),
+                   seed=seed,
                    verbose=False)
     print("Function value: %s" % res.F[0])
     print("Subset:", np.where(res.X)[0])
+    print(f"Genetic algorithm: {res.algorithm.n_gen} generations of {algorithm.pop_size} loadouts "
+          f"in {res.exec_time:.2f}s, stopped on {res.algorithm.termination.reason}")
     return np.where(res.X)[0], res
@@ -1,9 +1,21 @@
 import argparse
 import base64
+import binascii
+import contextlib
+import fnmatch
+import heapq
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
 import sys
+import tempfile
+import time
 import logging
-from deserialize_dot_net import Deserializer
+from deserialize_dot_net import Deserializer, compile_path, extract_columns, json_default, unwrap
+from archives import is_archive, iter_members, read_member, split_member
+from row_cache import RowCache
 
 HEADERS = {
     "playtime": "totalPlaytime/value/totalseconds",
@@ -22,6 +34,9 @@ HEADERS = {
     "itopod_end": "adventure/value/itopodEnd",
 }
 
+# save files picked up by --watch
+SAVE_PATTERN = 'NGUSave-Build*.txt'
+
 GRAPH = {
     'size': (20, 10),
     'graphs': [
@@ -47,42 +62,405 @@ if sys.version_info < (3, 7):
     sys.exit(1)
 
 
-def read_savegame(fname):
-    """This is a complete hack"""
-    LOG.info(f"Reading: {fname}")
-    with open(fname, 'rb') as _fh:
-        a = _fh.read()
-        data = base64.b64decode(a)
+# CSV rows sorted in memory before spilling them to a temporary file
+SORT_CHUNK_ROWS = 100000
+
+# saves read ahead per process, bounds the archive members held in memory
+BATCH_PER_JOB = 32
+
+# base64 characters decoded per step, must be a multiple of 4
+CHUNK_SIZE = 1 << 18
+
+
+def decode_b64_chunks(data, chunk_size=CHUNK_SIZE):
+    """Yield the decoded base64 of data a chunk at a time"""
+    for start in range(0, len(data), chunk_size):
+        yield binascii.a2b_base64(data[start:start + chunk_size])
+
+
+def decode_payload(text, chunk_size=CHUNK_SIZE):
+    """Return (buffer, length) of the double base64 encoded BinaryFormatter payload
+
+    The outer encoding is decoded a chunk at a time and its output, the base64
+    text of the payload, is decoded straight into one preallocated buffer, so
+    only the mapped file and the final payload are ever full size.
+    """
+    buf = bytearray(len(text) // 4 * 3 // 4 * 3)
+    size = 0
+    head = b''
+    tail = b''
+    for chunk in decode_b64_chunks(text, chunk_size):
+        if head is not None:
+            head += chunk
+            offset = head.find(b'checksum')
+            if offset == -1 or len(head) < offset + 34:
+                continue
+            chunk = memoryview(head)[offset + 34:]
+            head = None
+        # only decode whole groups of 4, the rest waits for the next chunk
+        if tail:
+            chunk = tail + chunk
+        split = len(chunk) - len(chunk) % 4
+        tail = bytes(chunk[split:])
+        decoded = binascii.a2b_base64(chunk[:split])
+        buf[size:size + len(decoded)] = decoded
+        size += len(decoded)
+    if head is not None:
+        raise ValueError("Failed to find checksum")
+    if tail:
+        decoded = binascii.a2b_base64(tail)
+        buf[size:size + len(decoded)] = decoded
+        size += len(decoded)
+    return buf, size
+
+
+def decode_savegame(fname, text=None):
+    """Return the decoded BinaryFormatter payload and the offset of PlayerData
+
+    fname may name an archive member ('<archive>/<member>'). text is the
+    content of the save if it was already read. Raises ValueError if fname is
+    not a save, so callers in worker processes can report it.
+    """
+    if text is None:
+        archive, member = split_member(fname)
+        if archive is not None:
+            text = read_member(archive, member)
+    if text is None:
+        with open(fname, 'rb') as _fh:
+            try:
+                text = mmap.mmap(_fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                text = b''
+    try:
         try:
-            offset = data.index(b'checksum') + 34
-        except:
-            logging.critical("Failed to find checksum")
-            sys.exit(1)
-        data = base64.b64decode(data[offset:])
-        ret = []
-        des = Deserializer(data, data.index(b'PlayerData') - 6)
+            buf, size = decode_payload(text)
+        except binascii.Error:
+            # line breaks can leave partial groups of 4 in a chunk, decode in one go
+            data = base64.b64decode(text)
+            buf = bytearray(base64.b64decode(data[data.index(b'checksum') + 34:]))
+            size = len(buf)
+    except ValueError:
+        raise ValueError(f"Failed to find checksum in {fname}") from None
+    finally:
+        if isinstance(text, mmap.mmap):
+            text.close()
+    del buf[size:]
+    try:
+        return buf, buf.index(b'PlayerData') - 6
+    except ValueError:
+        raise ValueError(f"Failed to find PlayerData in {fname}") from None
+
+
+def read_savegame(fname, projection=None, lazy=False, compact=False, text=None):
+    """This is a complete hack
+
+    projection optionally limits parsing to a list of DictQuery paths.
+    With lazy=True the save is only indexed and records are parsed as they
+    are accessed (projection is then not needed and ignored).
+    compact=True stores objects as CompactRecords to save memory.
+    text is the content of the save file if it was already read.
+    """
+    LOG.info(f"Reading: {fname}")
+    data, pos = decode_savegame(fname, text)
+    des = Deserializer(data, pos, None if lazy else projection, compact=compact)
+    if lazy:
+        des.scan()
+    else:
         des.parse()
-        ret = des.get('PlayerData')
-        return ret
+    ret = des.get('PlayerData')
+    return ret
+
+
+def extract_row(fname, text=None):
+    """Parse just the HEADERS fields of a save and return their values"""
+    obj = read_savegame(fname, list(HEADERS.values()), text=text)
+    return [compile_path(key + "/value")(obj) for key in HEADERS.values()]
+
+
+def header_columns(trees):
+    """Return {header: column} of the HEADERS values of parsed saves"""
+    columns = extract_columns(trees, [_k + "/value" for _k in HEADERS.values()])
+    return dict(zip(HEADERS, columns.values()))
+
+
+def select_fields(obj, fields, unwrap_values=False):
+    """Return {path: value} of the DictQuery paths in fields"""
+    return {_p: unwrap(obj.get(_p)) if unwrap_values else obj.get(_p) for _p in fields}
+
+
+def init_worker(level):
+    # spawned workers (Windows, macOS) do not inherit the logging setup
+    logging.basicConfig(level=level)
+
+
+def extract_source(source):
+    """Return the HEADERS row of a (name, text) source, or the exception reading it raised"""
+    try:
+        return extract_row(*source)
+    except Exception as _e:
+        # returned rather than raised, so one bad save does not fail a whole pool.map batch
+        return _e
+
+
+def iter_sources(saves, skip=None):
+    """Yield (name, text) of each save, text is None for plain files
+
+    Archives are replaced by their SAVE_PATTERN members, read in one pass.
+    Saves for which skip(name) is true are left out.
+    """
+    for fname in saves:
+        members = iter_members(fname, SAVE_PATTERN) if is_archive(fname) else [(fname, None)]
+        for name, text in members:
+            if not (skip and skip(name)):
+                yield name, text
+
+
+def iter_rows(saves, jobs=1, level=logging.INFO, cache=None, skip=None, on_error=None):
+    """Yield (name, HEADERS row) of each save, in order, using `jobs` processes
+
+    Rows found in cache (a RowCache) are not parsed again, new ones are added
+    to it. Saves are read BATCH_PER_JOB per process at a time, so archives are
+    streamed rather than loaded whole. A save that fails to parse raises its
+    error, or with on_error is passed to on_error(name, error) and left out.
+    """
+    sources = iter_sources(saves, skip)
+    with contextlib.ExitStack() as stack:
+        pool = None
+        while True:
+            batch = list(itertools.islice(sources, jobs * BATCH_PER_JOB))
+            if not batch:
+                break
+            rows = [cache.get(*_s) if cache else None for _s in batch]
+            missing = [_s for _s, _row in zip(batch, rows) if _row is None]
+            LOG.debug(f"{len(batch) - len(missing)} of {len(batch)} saves found in cache")
+            if jobs == 1 or len(missing) < 2:
+                parsed = map(extract_source, missing)
+            else:
+                if pool is None:
+                    pool = stack.enter_context(multiprocessing.Pool(jobs, init_worker, (level,)))
+                # a few chunks per worker keeps them busy without much IPC
+                chunksize = max(1, len(missing) // (jobs * 4))
+                parsed = iter(pool.map(extract_source, missing, chunksize))
+            for (name, _), row in zip(batch, rows):
+                if row is None:
+                    row = next(parsed)
+                    if isinstance(row, Exception):
+                        if on_error is None:
+                            raise row
+                        on_error(name, row)
+                        continue
+                    if cache:
+                        cache.put(name, row)
+                yield name, row
+
+
+def extract_rows(saves, jobs=1, level=logging.INFO, cache=None):
+    """Return the HEADERS row of each save, see iter_rows"""
+    return [_row for _, _row in iter_rows(saves, jobs, level, cache)]
+
+
+def spill_rows(rows):
+    """Write rows to a temporary file and return an iterator reading them back"""
+    _fh = tempfile.TemporaryFile('w+')
+    for row in rows:
+        _fh.write(json.dumps(row) + '\n')
+    _fh.seek(0)
+    return (json.loads(_l) for _l in _fh)
+
+
+def sort_rows(rows, key, chunk_rows=SORT_CHUNK_ROWS):
+    """Yield rows sorted by key, holding at most chunk_rows of them in memory
+
+    Each chunk is sorted and, when there is more than one, spilled to a
+    temporary file; the sorted chunks are then merged.
+    """
+    chunks = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            chunk.sort(key=key)
+            chunks.append(spill_rows(chunk))
+            chunk = []
+    chunk.sort(key=key)
+    if not chunks:
+        yield from chunk
+        return
+    if chunk:
+        chunks.append(spill_rows(chunk))
+    yield from heapq.merge(*chunks, key=key)
+
+
+def write_json(trees, out, single=False):
+    """Write trees as a JSON list, one tree at a time
+
+    The output is the same as json.dumps(list(trees), indent=2), or just the
+    tree if single is set, without holding all trees or the whole string.
+    """
+    if single:
+        out.write(json.dumps(next(trees), sort_keys=True, indent=2, default=json_default) + '\n')
+        return
+    sep = '[\n  '
+    for tree in trees:
+        # JSON strings never contain a raw newline, so this indents every line
+        out.write(sep + json.dumps(tree, sort_keys=True, indent=2, default=json_default).replace('\n', '\n  '))
+        sep = ',\n  '
+    out.write('[]\n' if sep == '[\n  ' else '\n]\n')
+
+
+def draw_graph(figure, graphdata):
+    """Draw the GRAPH layout of graphdata ({header: values}) on figure"""
+    import pandas as pd
+    import seaborn as sns
+    data = pd.DataFrame(data=graphdata)
+    sns.set_theme()
+    rows = len(GRAPH['graphs'])
+    cols = max([len(_x) for _x in GRAPH['graphs']])
+    gridspec = figure.add_gridspec(rows, cols)
+    for row in range(0, rows):
+        for col in range(0, len(GRAPH['graphs'][row])):
+            _ax = figure.add_subplot(gridspec[row, col])
+            graph = GRAPH['graphs'][row][col]
+            for key in graph['fields']:
+                if key not in HEADERS:
+                    LOG.error(f"Cannot plot unknown key '{key}'")
+                    continue
+                label = key  # if len(graph['fields']) > 1 else None
+                sns.scatterplot(data=data, x='playtime', y=key, label=label, ax=_ax)
+                if graph.get('log'):
+                    _ax.set(yscale="log")
+    figure.tight_layout()
+
+
+def scan_saves(directory):
+    """Return {path: (size, mtime)} of the save files in directory"""
+    ret = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and fnmatch.fnmatch(entry.name, SAVE_PATTERN):
+                stat = entry.stat()
+                ret[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return ret
+
+
+def stable_saves(directory, age):
+    """Return scan_saves(directory) without the saves modified in the last age seconds"""
+    cutoff = time.time_ns() - int(age * 1e9)
+    return {_p: _s for _p, _s in scan_saves(directory).items() if _s[1] <= cutoff}
+
+
+def watch_saves(directory, interval, seen, retry):
+    """Every interval seconds yield the list of new save files in directory
+
+    seen maps the saves already read to their (size, mtime) and is updated
+    with the ones yielded. A file is only new once its size and mtime did not
+    change between two polls, so saves still being written are not read.
+    Saves the caller adds to the retry set are new again once they change.
+    """
+    pending = {}
+    while True:
+        time.sleep(interval)
+        current = {_p: _s for _p, _s in scan_saves(directory).items()
+                   if _p not in seen or (_p in retry and seen[_p] != _s)}
+        ready = sorted(_p for _p, _s in current.items() if pending.get(_p) == _s)
+        for path in ready:
+            seen[path] = current[path]
+            retry.discard(path)
+        pending = current
+        yield ready
+
+
+def retry_later(retry):
+    """Return an iter_rows on_error callback logging the save and adding it to retry"""
+    def on_error(name, error):
+        LOG.error(f"Failed to read {name}, retrying once it changes: {error}")
+        retry.add(name)
+    return on_error
+
+
+def watch(args, level, seen, retry, cache=None, store=None, graphdata=None, figure=None):
+    """Ingest new saves in args.watch, printing CSV rows or redrawing the graph
+
+    seen and retry are passed to watch_saves, saves that fail to parse are
+    logged and read again once they change.
+    """
+    last_draw = time.monotonic()
+    changed = False
+    for saves in watch_saves(args.watch, args.interval, seen, retry):
+        if store is not None:
+            saves = store.new_saves(saves)
+        named_rows = list(iter_rows(saves, args.jobs or os.cpu_count(), level, cache,
+                                    on_error=retry_later(retry))) if saves else []
+        if named_rows:
+            saves = [_n for _n, _ in named_rows]
+            rows = [_r for _, _r in named_rows]
+            if cache:
+                cache.commit()
+            if store is not None:
+                store.append(saves, rows)
+            if args.csv:
+                for row in rows:
+                    print(",".join(str(_v) for _v in row), flush=True)
+            elif store is not None:
+                graphdata = store.load()
+            else:
+                for header, values in zip(HEADERS, zip(*rows)):
+                    graphdata[header].extend(values)
+            changed = True
+        if args.graph and changed and time.monotonic() - last_draw >= args.graph_interval:
+            figure.clf()
+            draw_graph(figure, graphdata)
+            figure.savefig(args.outfile)
+            last_draw = time.monotonic()
+            changed = False
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("saves", metavar='SAVEFILE', nargs='+',
+    parser.add_argument("saves", metavar='SAVEFILE', nargs='*',
                         help="List of save files to parse")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--json", action="store_true",
                        help="Generate JSON output")
+    group.add_argument("--jsonl", action="store_true",
+                       help="Generate JSON Lines output, one save per line")
     group.add_argument("--csv", action="store_true",
                        help="Generate output as CSV")
     group.add_argument("--graph", action="store_true",
                        help="Generate graphs")
+    parser.add_argument("--fields", metavar='PATHS',
+                        help="Only export these comma separated paths (e.g. adventure,inventory/value/accs) "
+                             "with --json/--jsonl")
+    parser.add_argument("--unwrap", action="store_true",
+                        help="Export plain values, without the type/code/value wrappers (--json/--jsonl)")
     parser.add_argument("--debug", action="store_true",
                         help="Generate extra debug information")
     parser.add_argument("--outfile",
                         help="save results in file")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Parse saves in this many processes for --csv/--graph (0: one per core)")
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument("--no-cache", action="store_true",
+                             help="Parse every save, without reading or updating the cache")
+    cache_group.add_argument("--rebuild-cache", action="store_true",
+                             help="Drop all cached rows and parse every save again")
+    parser.add_argument("--store", metavar='DIR',
+                        help="Add the saves to the column store in DIR and output all of it (--csv/--graph)")
+    parser.add_argument("--watch", metavar='DIR',
+                        help=f"Keep adding new {SAVE_PATTERN} files in DIR (--csv, or --graph with --outfile)")
+    parser.add_argument("--interval", type=float, default=10,
+                        help="Seconds between checks for new saves with --watch")
+    parser.add_argument("--graph-interval", type=float, default=60,
+                        help="Minimum seconds between graph updates with --watch")
     args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    if not args.saves and not (args.store or args.watch):
+        parser.error("at least one SAVEFILE is required")
+    if args.watch and not (args.csv or (args.graph and args.outfile)):
+        parser.error("--watch requires --csv, or --graph with --outfile")
+    fields = args.fields.split(',') if args.fields else None
+    level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=level)
     if args.graph:
         # graph import can be slow, so only do it if we need it
         try:
@@ -90,8 +468,9 @@ def main():
             if args.outfile:
                 matplotlib.use('Agg')
             import matplotlib.pyplot as plt
-            import seaborn as sns
-            import pandas as pd
+            # only an install check, draw_graph imports them itself; fail before parsing any saves
+            import seaborn
+            import pandas
         except Exception:
             LOG.error("Graphing modules not found.  Install via")
             LOG.error("pip install seaborn")
@@ -107,57 +486,80 @@ def main():
             LOG.error("Displaying plot failed with error:\n    %s", _e)
             LOG.error("You still may be able to save the graph using --outfile <image.png>")
             sys.exit(1)
-    jsondata = []
-    csvdata = []
     graphdata = {_k: [] for _k in HEADERS}
+    cache = None
 
-    for fname in args.saves:
-        obj = read_savegame(fname)
-        if args.json:
-            jsondata.append(obj)
-            continue
-        row = []
-        for header, key in HEADERS.items():
-            val = obj.get(key + "/value")
+    try:
+        if args.json or args.jsonl:
+            # only JSON output needs the whole tree, each is written as soon as it is parsed
+            trees = (read_savegame(_f, fields, compact=True, text=_t) for _f, _t in iter_sources(args.saves))
+            if fields:
+                trees = (select_fields(_t, fields, args.unwrap) for _t in trees)
+            elif args.unwrap:
+                trees = (unwrap(_t) for _t in trees)
+            if args.json:
+                write_json(trees, sys.stdout, single=len(args.saves) == 1 and not is_archive(args.saves[0]))
+            else:
+                for tree in trees:
+                    sys.stdout.write(json.dumps(tree, sort_keys=True, default=json_default) + '\n')
+        else:
+            saves = args.saves
+            # saves changed within the last interval may still be written, the watcher reads them once stable
+            seen = stable_saves(args.watch, args.interval) if args.watch else {}
+            retry = set()
+            saves += sorted(seen)
+            if args.store:
+                try:
+                    from column_store import ColumnStore
+                except ImportError:
+                    LOG.error("--store requires numpy.  Install via")
+                    LOG.error("pip install numpy")
+                    sys.exit(1)
+                store = ColumnStore(args.store, HEADERS)
+            cache = None if args.no_cache else RowCache(HEADERS, rebuild=args.rebuild_cache)
+            named_rows = iter_rows(saves, args.jobs or os.cpu_count(), level, cache,
+                                   store.__contains__ if args.store else None,
+                                   retry_later(retry) if args.watch else None)
+            if args.store:
+                named_rows = list(named_rows)
+                store.append([_n for _n, _ in named_rows], [_r for _, _r in named_rows])
+                graphdata = store.load()
+                # already sorted by playtime
+                rows = zip(*(_c.tolist() for _c in graphdata.values()))
+            else:
+                rows = (_row for _, _row in named_rows)
+                if args.csv:
+                    # playtime is the first column, saves without one go last
+                    rows = sort_rows(rows, key=lambda _r: (_r[0] is None, _r[0] or 0))
             if args.csv:
-                row.append(str(val))
-                continue
-            if args.graph:
-                graphdata[header].append(val)
-        if args.csv:
-            csvdata.append(row)
-    if args.json:
-        if len(args.saves) == 1:
-            jsondata = jsondata[0]
-        print(json.dumps(jsondata, sort_keys=True, indent=2))
-    elif args.csv:
-        csvdata.sort(key=lambda _x: _x[0])
-        csvdata = [list(HEADERS.keys())] + csvdata
-        for row in csvdata:
-            print(",".join(row))
-    elif args.graph:
-        data = pd.DataFrame(data=graphdata)
-        sns.set_theme()
-        rows = len(GRAPH['graphs'])
-        cols = max([len(_x) for _x in GRAPH['graphs']])
-        gridspec = figure.add_gridspec(rows, cols)
-        for row in range(0, rows):
-            for col in range(0, len(GRAPH['graphs'][row])):
-                _ax = figure.add_subplot(gridspec[row, col])
-                graph = GRAPH['graphs'][row][col]
-                for key in graph['fields']:
-                    if key not in HEADERS:
-                        LOG.error(f"Cannot plot unknown key '{key}'")
-                        continue
-                    label = key  # if len(graph['fields']) > 1 else None
-                    sns.scatterplot(data=data, x='playtime', y=key, label=label, ax=_ax)
-                    if graph.get('log'):
-                        _ax.set(yscale="log")
-        plt.tight_layout()
+                print(",".join(HEADERS))
+                for row in rows:
+                    print(",".join(str(_v) for _v in row))
+            elif not args.store:
+                for row in rows:
+                    for header, val in zip(HEADERS, row):
+                        graphdata[header].append(val)
+            if cache:
+                cache.commit()
+    except ValueError as _e:
+        # raised by decode_savegame, also from the worker processes
+        LOG.critical(_e)
+        sys.exit(1)
+    if args.graph:
+        draw_graph(figure, graphdata)
         if args.outfile:
             figure.savefig(args.outfile)
         else:
             plt.show()
+    if args.watch:
+        sys.stdout.flush()
+        try:
+            watch(args, level, seen, retry, cache, store if args.store else None, graphdata,
+                  figure if args.graph else None)
+        except KeyboardInterrupt:
+            pass
+    if cache:
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+"""On-disk cache of the HEADERS rows extracted from save files"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+# bump when the stored row format changes
+SCHEMA = 1
+
+
+def default_path():
+    """sqlite file in the user cache directory"""
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'ngu-save-parser', 'rows.sqlite')
+
+
+def file_hash(fname):
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as _fh:
+        for chunk in iter(lambda: _fh.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RowCache:
+    """Extracted rows keyed by file path, size, mtime and content hash
+
+    A file whose size and mtime match its entry is a hit without being read.
+    Otherwise the content hash is compared, so touched, copied or renamed
+    saves are not parsed again either. All rows are dropped when `headers`
+    (or SCHEMA) differ from the ones the cache was built with, or when
+    rebuild is set.
+    """
+    def __init__(self, headers, path=None, rebuild=False):
+        path = path or default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows "
+                        "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT, row TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rows_hash ON rows (hash)")
+        version = json.dumps({'schema': SCHEMA, 'headers': headers})
+        stored = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if rebuild or stored is None or stored[0] != version:
+            self.db.execute("DELETE FROM rows")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        # path -> (size, mtime, hash) of files looked up, for put
+        self.keys = {}
+
+    def key(self, path):
+        if path not in self.keys:
+            stat = os.stat(path)
+            self.keys[path] = (stat.st_size, stat.st_mtime_ns, file_hash(path))
+        return self.keys[path]
+
+    def get(self, fname, data=None):
+        """Return the cached row of fname or None
+
+        data is the content of saves read from archives, which are only
+        matched by their hash.
+        """
+        path = os.path.abspath(fname)
+        entry = self.db.execute("SELECT size, mtime, hash, row FROM rows WHERE path = ?",
+                                (path,)).fetchone()
+        if data is not None:
+            self.keys[path] = (len(data), 0, hashlib.sha256(data).hexdigest())
+        else:
+            stat = os.stat(path)
+            if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                return json.loads(entry[3])
+        size, _, digest = self.key(path)
+        if entry is None or entry[2] != digest:
+            entry = self.db.execute("SELECT size, mtime, hash, row FROM rows WHERE hash = ? AND size = ?",
+                                    (digest, size)).fetchone()
+        if entry is None:
+            return None
+        self.store(path, entry[3])
+        return json.loads(entry[3])
+
+    def put(self, fname, row):
+        self.store(os.path.abspath(fname), json.dumps(row))
+
+    def store(self, path, row):
+        self.db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?)",
+                        (path,) + self.key(path) + (row,))
+        del self.keys[path]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -2,6 +2,7 @@
 import sys
 import logging
 import math
+import time
 from dataclasses import dataclass
 from optimizer import run_optimizer
 import numpy as np
@@ -42,88 +43,110 @@ class Stats:
     daycare: float = 100
 
 
+def stat_terms(L, x):
+    """1 + the sum of each stat row of L over the selected items
+
+    x is a boolean item mask, or a population of masks (one per row), in
+    which case every stat is a row of per individual sums.
+    """
+    return 1 + L @ np.transpose(x)
+
+
+def monotone(generator, indices, sign=1):
+    """Mark generator as non-decreasing (sign 1) or non-increasing (-1) in the stats of indices
+
+    The exact solver in optimizer.py relies on this to bound the objective.
+    """
+    generator.signs = {_i: sign for _i in indices}
+    return generator
+
+
 def func_ABC_ADE(indices, skew=1.0):
     A, B, C, D, E = indices
 
     def generator(L, x):
-        return ((1 + np.sum(L[A][x])) *
-                (skew * (1 + np.sum(L[B][x])) * (1 + np.sum(L[C][x])) + (1 + np.sum(L[D][x])) * (1 + np.sum(L[E][x]))))
+        T = stat_terms(L, x)
+        return T[A] * (skew * T[B] * T[C] + T[D] * T[E])
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_ABsqrtC_ADsqrtE(indices, skew=1.0):
     A, B, C, D, E = indices
 
     def generator(L, x):
-        term1 = (1 + np.sum(L[B][x])) * math.sqrt(1 + np.sum(L[C][x]))
-        term2 = (1 + np.sum(L[D][x])) * math.sqrt(1 + np.sum(L[E][x]))
-        return (1 + np.sum(L[A][x])) * (skew * term1 + term2)
+        T = stat_terms(L, x)
+        return T[A] * (skew * T[B] * np.sqrt(T[C]) + T[D] * np.sqrt(T[E]))
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_ABC(indices, **_args):
     A, B, C = indices
 
     def generator(L, x):
-        return (1 + np.sum(L[A][x])) * ((1 + np.sum(L[B][x])) * (1 + np.sum(L[C][x])))
+        T = stat_terms(L, x)
+        return T[A] * (T[B] * T[C])
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_ABsqrtC(indices, **_args):
     A, B, C = indices
 
     def generator(L, x):
-        return (1 + np.sum(L[A][x])) * ((1 + np.sum(L[B][x])) * math.sqrt(1 + np.sum(L[C][x])))
+        T = stat_terms(L, x)
+        return T[A] * (T[B] * np.sqrt(T[C]))
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_AB(indices, **_args):
     A, B = indices
 
     def generator(L, x):
-        return ((1 + np.sum(L[A][x])) * (1 + np.sum(L[B][x])))
+        T = stat_terms(L, x)
+        return T[A] * T[B]
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_AB_CD(indices, skew=1.0):
     A, B, C, D = indices
 
     def generator(L, x):
-        return skew * (1 + np.sum(L[A][x])) * (1 + np.sum(L[B][x])) + (1 + np.sum(L[C][x])) * (1 + np.sum(L[D][x]))
+        T = stat_terms(L, x)
+        return skew * T[A] * T[B] + T[C] * T[D]
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_AB_AC(indices, skew=1.0):
     A, B, C = indices
 
     def generator(L, x):
-        return (1 + np.sum(L[A][x])) * (skew * (1 + np.sum(L[B][x])) + (1 + np.sum(L[C][x])))
+        T = stat_terms(L, x)
+        return T[A] * (skew * T[B] + T[C])
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_A(indices, **_args):
     A, = indices
 
     def generator(L, x):
-        return 1 + np.sum(L[A][x])
+        return stat_terms(L, x)[A]
 
-    return generator
+    return monotone(generator, indices)
 
 
 def func_negA(indices, **_args):
     A, = indices
 
     def generator(L, x):
-        return -1 * (1 + np.sum(L[A][x]))
+        return -1 * stat_terms(L, x)[A]
 
-    return generator
+    return monotone(generator, indices, -1)
 
 
 STAT_MAP = {
@@ -382,7 +405,9 @@ def compare_stats(ref_stats, stats, priorities):
     return False
 
 
-def optimize_items(all_items, locked, priorities):
+def optimize_items(all_items, locked, priorities, max_gens=200, time_budget=None):
+    # time_budget (seconds) is shared by the GA runs of all priorities
+    start = time.perf_counter()
     def items_by_type(items, itype):
         return [_ for _ in items if _['type'] == itype and _ not in locked]
 
@@ -459,8 +484,9 @@ def optimize_items(all_items, locked, priorities):
             func = _map['func'](indices, skew=skew)
         else:
             func = func_A([stypes.index(priority)])
+        budget = None if time_budget is None else max(time_budget - (time.perf_counter() - start), 0)
         indices, res = run_optimizer(stats, offset, item_groups, func,
-                                     unique=item_ids)
+                                     unique=item_ids, max_gens=max_gens, time_budget=budget)
         loadout = [items[_] for _ in indices]
         locked = loadout
     # print(calc_priority(calc_stats(loadout), 'ngu'))
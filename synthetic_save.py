@@ -0,0 +1,306 @@
+"""Generate synthetic NGU save games (.NET BinaryFormatter / NRBF streams)
+
+The generated PlayerData only uses the record types Deserializer.parse
+understands (classes, class refs, primitive arrays, object arrays, object
+references, null values and null runs) and carries the fields used by
+parse_saves.HEADERS and optimize.py, so both tools run on the output.
+"""
+import argparse
+import base64
+import random
+import struct
+from items import Items
+
+# NRBF primitive type code -> struct format
+PRIM_FORMATS = {1: '<B', 6: '<d', 8: '<l', 9: '<q', 11: '<f'}
+
+
+class ClassDef:
+    """Class layout: fields are (name, type tag, type spec) as in parse_class"""
+    def __init__(self, name, fields, system=False):
+        self.name = name
+        self.fields = fields
+        self.system = system
+
+
+class Obj:
+    """Class instance; inline objects (value types) are written in place"""
+    def __init__(self, cls, values, inline=False):
+        self.cls = cls
+        self.values = values
+        self.inline = inline
+
+
+class PrimArray:
+    def __init__(self, primtype, values):
+        self.primtype = primtype
+        self.values = values
+
+
+class ObjArray:
+    """Array of `elem` class references, None elements are written as null runs"""
+    def __init__(self, elem, elements):
+        self.elem = elem
+        self.elements = elements
+
+
+def encode_str(value):
+    data = value.encode('utf8')
+    size = len(data)
+    out = bytearray()
+    while size >= 0x80:
+        out.append((size & 0x7f) | 0x80)
+        size >>= 7
+    out.append(size)
+    return bytes(out) + data
+
+
+class Writer:
+    """Serialize an object graph breadth first, like BinaryFormatter does"""
+    def __init__(self):
+        self.out = bytearray()
+        self.ids = {}
+        self.next_id = 1
+        self.meta = {}
+        self.queue = []
+        self.root_pos = None
+
+    def get_id(self, obj):
+        """Return (object id, whether it is new)"""
+        key = id(obj)
+        if key in self.ids:
+            return self.ids[key][0], False
+        # keep obj alive so id() stays unique
+        self.ids[key] = (self.next_id, obj)
+        self.next_id += 1
+        return self.next_id - 1, True
+
+    def write(self, root):
+        # SerializedStreamHeader and BinaryLibrary records precede the root
+        self.out += b'\x00' + struct.pack('<llll', 1, -1, 1, 0)
+        self.out += b'\x0c' + struct.pack('<l', 2) + encode_str('Assembly-CSharp, Version=0.0.0.0')
+        self.root_pos = len(self.out)
+        self.get_id(root)
+        self.queue.append(root)
+        while self.queue:
+            self.write_record(self.queue.pop(0))
+        self.out += b'\x0b'
+        return bytes(self.out)
+
+    def write_record(self, obj):
+        _id = self.ids[id(obj)][0]
+        if isinstance(obj, Obj):
+            self.write_object(_id, obj)
+        elif isinstance(obj, PrimArray):
+            fmt = PRIM_FORMATS[obj.primtype]
+            self.out += b'\x0f' + struct.pack('<LL', _id, len(obj.values)) + bytes([obj.primtype])
+            self.out += struct.pack(f'<{len(obj.values)}{fmt[1]}', *obj.values)
+        elif isinstance(obj, ObjArray):
+            self.out += b'\x07' + struct.pack('<L', _id) + b'\x00'
+            self.out += struct.pack('<LL', 1, len(obj.elements)) + b'\x04'
+            self.write_spec(4, (obj.elem, 2))
+            nulls = 0
+            for elem in obj.elements:
+                if elem is None:
+                    nulls += 1
+                    continue
+                self.write_nulls(nulls)
+                nulls = 0
+                self.write_value(4, None, elem)
+            self.write_nulls(nulls)
+
+    def write_object(self, _id, obj):
+        cls = obj.cls
+        if cls.name in self.meta:
+            self.out += b'\x01' + struct.pack('<LL', _id, self.meta[cls.name])
+        else:
+            self.meta[cls.name] = _id
+            self.out += b'\x04' if cls.system else b'\x05'
+            self.out += struct.pack('<L', _id) + encode_str(cls.name)
+            self.out += struct.pack('<L', len(cls.fields))
+            for name, _, _ in cls.fields:
+                self.out += encode_str(name)
+            self.out += bytes(_tag for _, _tag, _ in cls.fields)
+            for _, tag, spec in cls.fields:
+                self.write_spec(tag, spec)
+            if not cls.system:
+                self.out += struct.pack('<L', 2)
+        for name, tag, spec in cls.fields:
+            self.write_value(tag, spec, obj.values.get(name))
+
+    def write_nulls(self, count):
+        if count == 1:
+            self.out += b'\x0a'
+        elif 1 < count < 256:
+            self.out += bytes([13, count])
+        elif count:
+            self.out += b'\x0e' + struct.pack('<L', count)
+
+    def write_spec(self, tag, spec):
+        if tag in (0, 7):
+            self.out.append(spec)
+        elif tag == 3:
+            self.out += encode_str(spec)
+        elif tag == 4:
+            self.out += encode_str(spec[0]) + struct.pack('<L', spec[1])
+
+    def write_value(self, tag, spec, value):
+        if tag == 0:
+            self.out += struct.pack(PRIM_FORMATS[spec], value)
+        elif tag == 1:
+            _id, _ = self.get_id(object())
+            self.out += b'\x06' + struct.pack('<L', _id) + encode_str(value)
+        elif value is None:
+            self.out += b'\x0a'
+        elif isinstance(value, Obj) and value.inline:
+            self.get_id(value)
+            self.write_record(value)
+        else:
+            _id, new = self.get_id(value)
+            self.out += b'\x09' + struct.pack('<L', _id)
+            if new:
+                self.queue.append(value)
+
+
+def prims(pairs):
+    return [(_name, 0, _code) for _name, _code in pairs]
+
+
+ITEM_PART = ClassDef('part', prims([('value__', 8)]))
+SPEC_TYPE = ClassDef('specType', prims([('value__', 8)]))
+EQUIPMENT = ClassDef('Equipment', [
+    ('curAttack', 0, 11), ('curDefense', 0, 11), ('id', 0, 8), ('level', 0, 8),
+    ('type', 4, ('part', 2)),
+    ('spec1Cur', 0, 11), ('spec1Type', 4, ('specType', 2)),
+    ('spec2Cur', 0, 11), ('spec2Type', 4, ('specType', 2)),
+    ('spec3Cur', 0, 11), ('spec3Type', 4, ('specType', 2)),
+    ('removable', 0, 1), ('name', 1, None),
+])
+EQUIPMENT_LIST = ClassDef('System.Collections.Generic.List`1[[Equipment]]', [
+    ('_items', 4, ('Equipment[]', 2)), ('_size', 0, 8), ('_version', 0, 8)], system=True)
+NGU = ClassDef('NGU', prims([('level', 9), ('progress', 6), ('target', 9)]))
+# specials with a divisor in spectype.SpecType, so optimize.py accepts them
+SPECIALS = (1, 3, 5, 7, 8, 9, 20, 21, 22)
+
+
+def equipment(rnd, part):
+    itemid = rnd.choice(ITEM_IDS)
+    values = {
+        'curAttack': rnd.random() * 1e6, 'curDefense': rnd.random() * 1e6,
+        'id': itemid, 'level': rnd.randrange(101),
+        'type': Obj(ITEM_PART, {'value__': part}, inline=True),
+        'removable': 1, 'name': Items[itemid],
+    }
+    for spec in (1, 2, 3):
+        values[f'spec{spec}Cur'] = float(rnd.randrange(1, 1000000))
+        values[f'spec{spec}Type'] = Obj(SPEC_TYPE, {'value__': rnd.choice(SPECIALS)}, inline=True)
+    return Obj(EQUIPMENT, values)
+
+
+def equipment_list(rnd, count, size, part=None):
+    elements = [equipment(rnd, rnd.randrange(6) if part is None else part) for _ in range(count)]
+    elements += [None] * (size - count)
+    return Obj(EQUIPMENT_LIST, {'_items': ObjArray('Equipment', elements),
+                                '_size': count, '_version': 1})
+
+
+ITEM_IDS = sorted(_id for _id in Items if _id)
+
+
+def player_data(scale=1, seed=1):
+    """PlayerData object graph; scale multiplies inventory, NGUs and tables"""
+    rnd = random.Random(seed)
+    playtime = Obj(ClassDef('Playtime', prims([('totalseconds', 6)])),
+                   {'totalseconds': rnd.random() * 1e7})
+    stats = Obj(ClassDef('Stats', prims([('totalExp', 9), ('highestBoss', 8), ('totalGold', 6)])),
+                {'totalExp': rnd.randrange(10 ** 12), 'highestBoss': rnd.randrange(302),
+                 'totalGold': rnd.random() * 1e88})
+    adventure = Obj(ClassDef('Adventure', prims([('attack', 11), ('defense', 11),
+                                                 ('highestItopodLevel', 8), ('itopodEnd', 8)])),
+                    {'attack': rnd.random() * 1e11, 'defense': rnd.random() * 1e11,
+                     'highestItopodLevel': rnd.randrange(2000), 'itopodEnd': rnd.randrange(2000)})
+    magic = Obj(ClassDef('Magic', prims([('capMagic', 9), ('magicPower', 11), ('magicPerBar', 9)])),
+                {'capMagic': rnd.randrange(10 ** 13), 'magicPower': rnd.random() * 1e9,
+                 'magicPerBar': rnd.randrange(10 ** 9)})
+
+    slots = ('head', 'chest', 'legs', 'boots', 'weapon')
+    lists = ('accs', 'daycare', 'inventory', 'storage')
+    inv_fields = prims([('cubePower', 11), ('cubeToughness', 11)])
+    inv_fields += [(_slot, 4, ('Equipment', 2)) for _slot in slots]
+    inv_fields += [(_name, 4, (EQUIPMENT_LIST.name, 2)) for _name in lists]
+    inv_values = {'cubePower': rnd.random() * 1e6, 'cubeToughness': rnd.random() * 1e6}
+    for part, slot in enumerate(slots):
+        inv_values[slot] = equipment(rnd, part)
+    inv_values['accs'] = equipment_list(rnd, 12, 16, part=5)
+    inv_values['daycare'] = equipment_list(rnd, 3, 4)
+    inv_values['inventory'] = equipment_list(rnd, 60 * scale, 64 * scale)
+    # mostly empty, written as a 32 bit null run
+    inv_values['storage'] = equipment_list(rnd, scale, 300 * scale)
+    inventory = Obj(ClassDef('Inventory', inv_fields), inv_values)
+
+    ngus = ObjArray('NGU', [Obj(NGU, {'level': rnd.randrange(10 ** 9), 'progress': rnd.random(),
+                                      'target': 0}) for _ in range(200 * scale)])
+    tables = []
+    for _ in range(40 * scale):
+        primtype = rnd.choice((1, 6, 8, 9, 11))
+        size = rnd.randrange(50, 400)
+        if primtype in (6, 11):
+            values = [rnd.random() for _ in range(size)]
+        elif primtype == 1:
+            values = [rnd.randrange(2) for _ in range(size)]
+        else:
+            values = [rnd.randrange(10 ** 6) for _ in range(size)]
+        tables.append(PrimArray(primtype, values))
+
+    fields = [('totalPlaytime', 4, ('Playtime', 2)), ('stats', 4, ('Stats', 2)),
+              ('adventure', 4, ('Adventure', 2)), ('capEnergy', 0, 9), ('energyPower', 0, 11),
+              ('energyBars', 0, 9), ('magic', 4, ('Magic', 2)), ('inventory', 4, ('Inventory', 2)),
+              ('ngus', 4, ('NGU[]', 2)), ('playerName', 1, None)]
+    values = {'totalPlaytime': playtime, 'stats': stats, 'adventure': adventure,
+              'capEnergy': rnd.randrange(10 ** 13), 'energyPower': rnd.random() * 1e9,
+              'energyBars': rnd.randrange(10 ** 9), 'magic': magic, 'inventory': inventory,
+              'ngus': ngus, 'playerName': 'idler'}
+    for idx, table in enumerate(tables):
+        fields.append((f'table{idx}', 7, table.primtype))
+        values[f'table{idx}'] = table
+    return Obj(ClassDef('PlayerData', fields), values)
+
+
+def player_stream(scale=1, seed=1):
+    """Return (NRBF data, offset of the PlayerData record)"""
+    writer = Writer()
+    data = writer.write(player_data(scale, seed))
+    return data, writer.root_pos
+
+
+def deep_chain(depth):
+    """Return (NRBF data, root offset) of `depth` Node objects each referencing the next"""
+    node_cls = ClassDef('Node', [('next', 4, ('Node', 2)), ('v', 0, 9)])
+    nodes = [Obj(node_cls, {'v': _v}) for _v in range(1, depth + 1)]
+    for node, nxt in zip(nodes, nodes[1:]):
+        node.values['next'] = nxt
+    writer = Writer()
+    data = writer.write(nodes[0])
+    return data, writer.root_pos
+
+
+def encode_save(data):
+    """Wrap an NRBF stream the way NGU save files are (see parse_saves.decode_savegame)"""
+    payload = b'\x00' * 20 + b'checksum' + b'\x00' * 26 + base64.b64encode(data)
+    return base64.b64encode(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("outfile", help="Save file to write")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Size relative to a typical PlayerData")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+    data, _ = player_stream(args.scale, args.seed)
+    with open(args.outfile, 'wb') as _fh:
+        _fh.write(encode_save(data))
+
+
+if __name__ == "__main__":
+    main()